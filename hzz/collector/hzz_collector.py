@@ -1,11 +1,26 @@
-import awkward as ak
 import pickle
-import glob
+import json
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 import os
 import numpy as np
-import time
+import time # to measure time from the last rank to the plot
+import argparse # for passing command line arguments
+import multiprocessing # for a pool of processes loading rank files
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED # for loading several rank files at once
+
+import hzz_histograms # local file with the m4l histograms shared with the workers
+import hzz_handoff # local file with atomic writes and waiting for files of other stages
+
+#===================================================================================
+# Command line arguments
+
+parser = argparse.ArgumentParser(description='Merges the results of every rank and plots the 4-lepton invariant mass')
+parser.add_argument('--load_pool_size', default=os.cpu_count(), type=int, help='Number of rank files loaded and histogrammed at once (1 loads them one at a time)')
+parser.add_argument('--load_pool', default='process', choices=['thread','process'], help='Load rank files on a pool of threads or of processes')
+parser.add_argument('--load_memory', default=2000, type=float, help='MB of rank files loaded at once, a file bigger than this is loaded on its own')
+parser.add_argument('--fan_in', default=0, type=int, help='Fan-in of the reduction tree of hzz_reducer.py, the collector then merges the top level of reducers instead of the ranks (0 for no reducers)')
+args = parser.parse_args()
 
 #===================================================================================
 # Define variables
@@ -47,9 +62,8 @@ GeV = 1.0
 def check_start_file():
     return os.path.exists('data/starts.pkl') and os.path.exists('data/ends.pkl')
 
-# Wait until both files are present
-while not check_start_file():
-    time.sleep(1)
+# Wait until both files are present, the counter renames each into place once it is complete
+hzz_handoff.wait_until(check_start_file, 'data')
 
 # Finds out how many data files there should be
 with open('data/starts.pkl', 'rb') as sd:
@@ -57,86 +71,91 @@ with open('data/starts.pkl', 'rb') as sd:
 
 n = len(start_dicts)
 
-# Creates list of expected files
-files_list = []
-for i in range(n):
-    name = f'data/data_{i}.pkl'
-    files_list.append(name)
-
-# Check files in list exist
-def check_files(file_list):
-    return all(os.path.exists(file) for file in file_list)
-
-# Wait until all files in the list exist:
-while not check_files(files_list):
-    time.sleep(1)
-
-time.sleep(1) # To correct occasional error caused by script running fraction of a second too early 
 #===================================================================================
-# Import and process data
-
-# Get a list of all '.pkl' files in the current directory
-pkl_files = [file for file in os.listdir('./data') if file.endswith('.pkl') and file.startswith('data')]
-
-if len(pkl_files) == 0:
-    raise ImportError('No detected data files')
-
-ak_arrays = {}
-ak_list = []
-# Import each pickle file
-for pkl_file in pkl_files:
-    pkl_file_path = f'data/{pkl_file}'
-
-    with open(pkl_file_path, 'rb') as file:
-        var_name = f'data_{pkl_file_path[-5]}'
-        globals()[var_name] = pickle.load(file)
-        ak_list.append(globals()[var_name])
-
-# Combine all the data
-result_dict = {}
-
-# Iterate over the keys in one of the dictionaries (assuming they all have the same keys)
-for key in data_0.keys():
-    # Extract the arrays corresponding to the current key from all dictionaries
-    arrays = [d[key] for d in ak_list]
-
-    # Concatenate
-    concatenated_array = ak.concatenate(arrays, axis=0)
-    result_dict[key] = concatenated_array
+# Merge the result of each rank as soon as it finishes
+
+# Define function to load the file of a rank and get its histograms, timing how long it took
+def load_rank(output):
+    start = time.time()
+    histograms = hzz_histograms.saved_histograms(f'data/{output}', samples)
+    return histograms, time.time() - start
+
+# Define function to get the histograms of each category of every rank, loading each rank's file as soon as the rank
+# has finished (each rank adds an entry to data/finished once its file is in place), up to --load_pool_size files and
+# --load_memory MB at once. The histograms of each rank are small, so they are kept by rank and only added together
+# once every rank is in, in order of rank so the sums do not depend on the order ranks finished in.
+# Above level 0, the n reducers of that level of the reduction tree are merged in the same way
+def collect(n, level=0):
+    directory = hzz_handoff.level_directory(level)
+    name = 'rank' if level == 0 else f'level {level} reducer'
+    if args.load_pool == 'process' and args.load_pool_size > 1:
+        # processes are forked, and only hand back histograms, so loading scales with the cores of the node
+        pool = ProcessPoolExecutor(max_workers=args.load_pool_size, mp_context=multiprocessing.get_context('fork'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=max(args.load_pool_size, 1))
+
+    rank_results = {} # histograms of each rank, by rank
+    waiting = [] # (rank, file, bytes) of finished ranks not loaded yet
+    loading = {} # future loading a rank: (rank, bytes)
+    with pool:
+        while len(rank_results) < n:
+            if not waiting and not loading:
+                # nothing to do until another rank finishes
+                hzz_handoff.wait_until(lambda: any(i < n and i not in rank_results for i in hzz_handoff.finished_ranks(directory)),
+                                       directory)
+            seen = set(rank_results) | {i for i, _, _ in waiting} | {i for i, _ in loading.values()}
+            for i, entry in sorted(hzz_handoff.finished_ranks(directory).items()):
+                if i < n and i not in seen:
+                    waiting.append((i, entry['output'], os.path.getsize(f"data/{entry['output']}")))
+
+            # start loading finished ranks while there is room in the pool and under the memory cap
+            loading_bytes = sum(size for _, size in loading.values())
+            while waiting and len(loading) < max(args.load_pool_size, 1) and (not loading or loading_bytes + waiting[0][2] <= args.load_memory*1e6):
+                i, output, size = waiting.pop(0)
+                loading[pool.submit(load_rank, output)] = (i, size)
+                loading_bytes += size
+
+            if loading:
+                # look for newly finished ranks every so often while files are loading
+                done, _ = wait(loading, timeout=hzz_handoff.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, size = loading.pop(future)
+                    rank_results[i], elapsed = future.result()
+                    print(f'\t{name} {i} merged ({len(rank_results)}/{n}), {round(size/1e6,2)}MB in {round(elapsed,2)}s')
+
+    histograms = {s: hzz_histograms.empty_histogram() for s in samples}
+    for i in sorted(rank_results):
+        for s, histogram in rank_results[i].items():
+            hzz_histograms.add_histograms(histograms[s], histogram)
+    return histograms
 
 #===================================================================================
 # Function to plot data
 
-def plot_data(data):
+def plot_data(histograms):
 
-    xmin = 80 * GeV
-    xmax = 250 * GeV
-    step_size = 5 * GeV
+    xmin = hzz_histograms.xmin
+    xmax = hzz_histograms.xmax
+    step_size = hzz_histograms.step_size
 
-    bin_edges = np.arange(start=xmin, # The interval includes this value
-                     stop=xmax+step_size, # The interval doesn't include this value
-                     step=step_size ) # Spacing between values
-    bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
-                            stop=xmax+step_size/2, # The interval doesn't include this value
-                            step=step_size ) # Spacing between values
+    bin_edges = hzz_histograms.bin_edges
+    bin_centres = hzz_histograms.bin_centres
 
-    data_x,_ = np.histogram(ak.to_numpy(data['data']['mllll']), 
-                            bins=bin_edges ) # histogram the data
+    data_x = histograms['data']['counts'] # histogram of the data
     data_x_errors = np.sqrt( data_x ) # statistical error on the data
 
-    signal_x = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)']['mllll']) # histogram the signal
-    signal_weights = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)'].totalWeight) # get the weights of the signal events
+    signal_weights = histograms[r'Signal ($m_H$ = 125 GeV)']['sumw'] # sum of the weights of the signal events in each bin
     signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
 
-    mc_x = [] # define list to hold the Monte Carlo histogram entries
-    mc_weights = [] # define list to hold the Monte Carlo weights
+    mc_weights = [] # define list to hold the Monte Carlo sums of weights in each bin
+    mc_weights2 = [] # define list to hold the Monte Carlo sums of squared weights in each bin
     mc_colors = [] # define list to hold the colors of the Monte Carlo bars
     mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
 
     for s in samples: # loop over samples
         if s not in ['data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
-            mc_x.append( ak.to_numpy(data[s]['mllll']) ) # append to the list of Monte Carlo histogram entries
-            mc_weights.append( ak.to_numpy(data[s].totalWeight) ) # append to the list of Monte Carlo weights
+            mc_weights.append( histograms[s]['sumw'] ) # append to the list of Monte Carlo weights
+            mc_weights2.append( histograms[s]['sumw2'] ) # append to the list of Monte Carlo squared weights
             mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
             mc_labels.append( s ) # append to the list of Monte Carlo legend labels
     
@@ -146,27 +165,26 @@ def plot_data(data):
     # Main plot 
     # *************
     main_axes = plt.gca() # get current axes
-    
-    # plot the data points
-    main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
-                       fmt='ko', # 'k' means black and 'o' is for circles 
-                       label='Data') 
-    
-    # plot the Monte Carlo bars
-    mc_heights = main_axes.hist(mc_x, bins=bin_edges, 
-                                weights=mc_weights, stacked=True, 
-                                color=mc_colors, label=mc_labels )
-    
-    mc_x_tot = mc_heights[0][-1] # stacked background MC y-axis value
-    
+
+    # plot the Monte Carlo bars stacked on each other, drawn straight from the sums of weights without histogramming again
+    mc_x_tot = np.zeros(len(bin_centres)) # stacked background MC y-axis value
+    for weights, color, label in zip(mc_weights, mc_colors, mc_labels):
+        main_axes.bar(bin_centres, weights, width=step_size, bottom=mc_x_tot,
+                      color=color, label=label)
+        mc_x_tot = mc_x_tot + weights
+
     # calculate MC statistical uncertainty: sqrt(sum w^2)
-    mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
-    
+    mc_x_err = np.sqrt(np.sum(mc_weights2, axis=0))
+
     # plot the signal bar
-    main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot, 
-                   weights=signal_weights, color=signal_color,
-                   label=r'Signal ($m_H$ = 125 GeV)')
-    
+    main_axes.bar(bin_centres, signal_weights, width=step_size, bottom=mc_x_tot,
+                  color=signal_color, label=r'Signal ($m_H$ = 125 GeV)')
+
+    # plot the data points, after the bars so the legend lists them in the same order
+    main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
+                       fmt='ko', # 'k' means black and 'o' is for circles
+                       label='Data')
+
     # plot the statistical uncertainty
     main_axes.bar(bin_centres, # x
                   2*mc_x_err, # heights
@@ -231,11 +249,77 @@ def plot_data(data):
     # draw the legend
     main_axes.legend( frameon=False ) # no box around the legend
 
-    plt.savefig('data/graph.png')
+    with hzz_handoff.atomic_open('data/graph.png') as gf:
+        plt.savefig(gf, format='png') # only appears once complete, for scripts waiting on the plot
     #plt.show()
 
+#===================================================================================
+# Run summary and cost model
+
+# Where the cost model used by the counter is kept
+cost_model_path = 'data/cost_model.json'
+
+# Define function to print predicted and actual time of each rank
+def summarise_run(n):
+    predicted = [None]*n
+    if os.path.exists('data/plan.json'):
+        with open('data/plan.json', 'r') as pf:
+            predicted = json.load(pf)['predicted']
+
+    rank_timings = []
+    print('Time per rank:')
+    for i in range(n):
+        path = f'data/timings_{i}.json'
+        if not os.path.exists(path):
+            continue # worker did not record timings
+        with open(path, 'r') as t:
+            rank_timings.append(json.load(t))
+        actual = rank_timings[-1]['seconds']
+        if i < len(predicted) and predicted[i] is not None:
+            print(f'\trank {i}:\t predicted {round(predicted[i],1)}s,\t actual {round(actual,1)}s')
+        else:
+            print(f'\trank {i}:\t actual {round(actual,1)}s')
+    return rank_timings
+
+# Define function to update the cost model with the timings of this run,
+# averaging with earlier runs so one noisy run does not throw the model off
+def update_cost_model(rank_timings, path=cost_model_path, smoothing=0.5):
+    # Add up entries, seconds and bytes of each sample over every rank
+    totals = {}
+    for timing in rank_timings:
+        for sample, t in timing['files'].items():
+            total = totals.setdefault(sample, {'entries': 0, 'seconds': 0, 'bytes': 0})
+            for key in total:
+                total[key] += t[key]
+
+    cost_model = {}
+    if os.path.exists(path):
+        with open(path, 'r') as cm:
+            cost_model = json.load(cm)
+
+    for sample, total in totals.items():
+        if total['entries'] == 0:
+            continue
+        measured = {'seconds_per_event': total['seconds']/total['entries'],
+                    'bytes_per_event': total['bytes']/total['entries']}
+        if sample in cost_model:
+            measured = {key: smoothing*cost_model[sample][key] + (1-smoothing)*value for key, value in measured.items()}
+        cost_model[sample] = measured
+
+    with hzz_handoff.atomic_open(path, 'w') as cm:
+        json.dump(cost_model, cm, indent=1)
+    print(f'Cost model updated with {len(totals)} samples')
+
 def main(): 
     print('Collecting data')
-    plot_data(result_dict)
+    # histograms of each category, merged rank by rank (or reducer by reducer) as they finish
+    sizes = hzz_handoff.level_sizes(n, args.fan_in)
+    histograms = collect(sizes[-1], len(sizes) - 1)
+    last_rank = time.time() # every result is merged, only the plot is left
+    plot_data(histograms)
+    print(f'Plot saved {round(time.time()-last_rank,2)}s after the last result was merged')
+    rank_timings = summarise_run(n)
+    if rank_timings:
+        update_cost_model(rank_timings)
 
 main()
\ No newline at end of file
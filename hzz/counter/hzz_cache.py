@@ -0,0 +1,194 @@
+import uproot # for reading .root files
+import numpy as np
+import queue # uproot is told when chunks are filled through a queue
+import hashlib # to name the cache directory of each file
+import os
+import threading # to keep the running total of cached bytes right with several threads
+
+#===================================================================================
+# Local on-disk cache of byte ranges read from remote files, used by the counter and worker
+# through uproot.open(path, **open_options(path)). The same file is kept in counter and worker.
+#
+# Each remote file has a directory in the cache holding one file per byte range read from it,
+# named <start>-<stop>, and its size. A range is read from the cache when a cached range holds
+# all of it. Files are used in least recently used order: reading a range updates its
+# modification time, and when the cache is over its size cap the oldest ranges are deleted.
+
+# Where the cache is kept and how many bytes it may hold, directory None turns the cache off
+settings = {'directory': None, 'max_bytes': 2e9}
+
+# Bytes in the cache, counted when first needed and kept up to date as ranges are added
+cache_state = {'bytes': None, 'hits': 0, 'misses': 0, 'fetched_bytes': 0}
+cache_lock = threading.Lock()
+
+#===================================================================================
+# Cache directory functions
+
+# Define function to get the options for uproot.open that read a file through the cache
+def open_options(path):
+    if settings['directory'] is None or '://' not in path:
+        return {} # cache off, or a local file that gains nothing from it
+    return {'handler': CachingSource}
+
+# Define function to get the directory of a file in the cache
+def file_directory(path):
+    return os.path.join(settings['directory'], hashlib.sha1(path.encode()).hexdigest())
+
+# Define function to write a file so that readers never see it half written
+def write_atomic(path, data):
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as tf:
+        tf.write(data)
+    os.replace(temp_path, path)
+
+# Define function to list the byte ranges of a file in the cache as (start, stop, path)
+def cached_ranges(directory):
+    ranges = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        start, _, stop = name.partition('-')
+        if start.isdigit() and stop.isdigit():
+            ranges.append((int(start), int(stop), os.path.join(directory, name)))
+    return ranges
+
+# Define function to list every cached range in the cache as (last used, bytes, path)
+def all_cached():
+    entries = []
+    for name in os.listdir(settings['directory']) if os.path.isdir(settings['directory']) else []:
+        for _, _, path in cached_ranges(os.path.join(settings['directory'], name)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+# Define function to delete least recently used ranges until the cache is under its cap, going
+# a tenth under so the whole cache is not looked through again for every range added
+def evict():
+    entries = sorted(all_cached())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= 0.9*settings['max_bytes']:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # removed by another process
+        total -= size
+    cache_state['bytes'] = total
+
+# Define function to add a range to the cache, evicting old ranges if it goes over the cap
+def add_range(directory, start, stop, data):
+    os.makedirs(directory, exist_ok=True)
+    write_atomic(os.path.join(directory, f'{start}-{stop}'), data.tobytes())
+    with cache_lock:
+        if cache_state['bytes'] is None:
+            cache_state['bytes'] = sum(size for _, size, _ in all_cached())
+        else:
+            cache_state['bytes'] += stop - start
+        if cache_state['bytes'] > settings['max_bytes']:
+            evict() # other processes share the cache, so look at what is really there
+
+#===================================================================================
+# uproot source
+
+# Source that serves byte ranges from the cache and fetches the rest with uproot's usual source
+class CachingSource(uproot.source.chunk.Source):
+    def __init__(self, file_path, **options):
+        super().__init__()
+        self._file_path = file_path
+        self._directory = file_directory(file_path)
+        self._ranges = cached_ranges(self._directory)
+        self._options = options
+        self._source = None # only connect to the server when a range is not in the cache
+
+    # Define function to get the source fetching ranges that are not cached, connecting on first use
+    def remote(self):
+        if self._source is None:
+            self._source = uproot.source.fsspec.FSSpecSource(self._file_path, **self._options) # uproot's usual source
+        return self._source
+
+    # Define function to find a range in the cache, returns None when it is not there
+    def lookup(self, start, stop):
+        for cached_start, cached_stop, path in self._ranges:
+            if cached_start <= start and stop <= cached_stop:
+                try:
+                    data = np.fromfile(path, dtype=np.uint8)
+                    os.utime(path) # most recently used
+                except FileNotFoundError:
+                    continue # evicted
+                if len(data) == cached_stop - cached_start:
+                    return data[start - cached_start:stop - cached_start]
+        return None
+
+    def chunk(self, start, stop):
+        self._num_requests += 1
+        self._num_requested_chunks += 1
+        self._num_requested_bytes += stop - start
+        data = self.lookup(start, stop)
+        if data is None:
+            data = self.remote().chunk(start, stop).raw_data
+            self.store(start, stop, data)
+        else:
+            cache_state['hits'] += 1
+        return uproot.source.chunk.Chunk.wrap(self, data, start)
+
+    def chunks(self, ranges, notifications):
+        self._num_requests += 1
+        self._num_requested_chunks += len(ranges)
+        self._num_requested_bytes += sum(stop - start for start, stop in ranges)
+
+        found = {(start, stop): self.lookup(start, stop) for start, stop in ranges}
+        missing = [r for r in ranges if found[r] is None]
+        cache_state['hits'] += len(ranges) - len(missing)
+        if missing:
+            # fetch every range not in the cache in one go, as uproot's source would have
+            fetched = self.remote().chunks(missing, queue.Queue())
+            for (start, stop), fetched_chunk in zip(missing, fetched):
+                found[start, stop] = fetched_chunk.raw_data
+                self.store(start, stop, found[start, stop])
+
+        chunks = []
+        for start, stop in ranges:
+            chunk = uproot.source.chunk.Chunk.wrap(self, found[start, stop], start)
+            notifications.put(chunk)
+            chunks.append(chunk)
+        return chunks
+
+    # Define function to add a fetched range to the cache
+    def store(self, start, stop, data):
+        cache_state['misses'] += 1
+        cache_state['fetched_bytes'] += stop - start
+        add_range(self._directory, start, stop, data)
+        self._ranges.append((start, stop, os.path.join(self._directory, f'{start}-{stop}')))
+
+    @property
+    def num_bytes(self):
+        if self._num_bytes is None:
+            size_path = os.path.join(self._directory, 'size')
+            if os.path.exists(size_path):
+                with open(size_path, 'r') as sf:
+                    self._num_bytes = int(sf.read())
+            else:
+                self._num_bytes = self.remote().num_bytes
+                os.makedirs(self._directory, exist_ok=True)
+                write_atomic(size_path, str(self._num_bytes).encode())
+        return self._num_bytes
+
+    @property
+    def closed(self):
+        return self._source is not None and self._source.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self._source is not None:
+            self._source.__exit__(exception_type, exception_value, traceback)
+
+#===================================================================================
+
+# Define function to describe how the cache was used, for printing at the end of a run
+def summary():
+    return (f"byte range cache: {cache_state['hits']} ranges from disk, {cache_state['misses']} fetched"
+            f" ({round(cache_state['fetched_bytes']/1e6,2)}MB)")
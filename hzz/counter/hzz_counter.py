@@ -1,17 +1,54 @@
-import uproot # for reading .root files
 import time # to measure time to analyse
 import argparse # for passing command line arguments
 import pickle
+import json
+import numpy as np # for the (files x ranks) matrices of start and end points
 import os
+import random # for choosing which MC files to check against infofile
+import shutil # for removing the work queue of the last run
+from concurrent.futures import ThreadPoolExecutor # for counting several files at once
 
 import infofile # local file containing cross-sections, sums of weights, dataset IDs
+import hzz_metadata # local file caching entry counts and basket boundaries of each file
+import hzz_planner # local file with planners that cut files on basket boundaries
+import hzz_cache # local file with the on-disk cache of byte ranges of remote files
+import hzz_mirror # local file with the local copy of the sample files
+import hzz_handoff # local file with atomic writes and waiting for files of other stages
 
 parser = argparse.ArgumentParser(description='Defines dictionaries with start and end points for each worker')
 parser.add_argument('--number_workers', default=1, help='Number of workers being used')
+parser.add_argument('--concurrency', default=1, type=int, help='Number of files to count at once (1 counts them one at a time)')
+parser.add_argument('--max_cache_age', default=hzz_metadata.default_max_age, type=float, help='Seconds before cached file metadata is checked against the server again')
+parser.add_argument('--no_cache', action='store_true', help='Ignore the metadata cache and count every file again')
+parser.add_argument('--mc_counts', default='remote', choices=['remote','infofile'], help='remote opens every MC file to count it, infofile takes MC entries from infofile and only opens the data files')
+parser.add_argument('--verify_sample', default=1, type=int, help='Number of MC files opened to check infofile against when using --mc_counts infofile')
+parser.add_argument('--planner', default='cluster', choices=['cluster','equal','affinity'], help='cluster cuts files on basket boundaries, equal cuts them into equal entry ranges, affinity gives whole files to single ranks and only splits the largest')
+parser.add_argument('--cluster_tolerance', default=0.1, type=float, help='Fraction of a range a cut can move to reach a basket boundary')
+parser.add_argument('--schedule', default='static', choices=['static','dynamic'], help='static gives each worker fixed ranges, dynamic puts small tasks on a queue for idle workers to take')
+parser.add_argument('--task_size', default=25000, type=int, help='Entries per task with dynamic scheduling')
+parser.add_argument('--cost_model', default=None, help='Cost model from earlier runs (e.g. data/cost_model.json) used to balance predicted time instead of entries')
+parser.add_argument('--byte_cache', default='data/byte_cache', help='Directory of the on-disk cache of byte ranges read from remote files, shared with the workers')
+parser.add_argument('--byte_cache_size', default=2000, type=float, help='MB the byte range cache may hold before the least recently used ranges are deleted')
+parser.add_argument('--no_byte_cache', action='store_true', help='Read remote files without the byte range cache')
+parser.add_argument('--mirror', default='data/mirror', help='Directory of the local copy of the sample files made by hzz_mirror.py, files it holds are read from local disk')
+parser.add_argument('--no_mirror', action='store_true', help='Read every file from the web address even if it is mirrored')
 args = parser.parse_args()
 
+# Unverified infofile counts are not safe to plan on, infofile events are the generated events of each sample
+# rather than the entries of the 4lep files (e.g. llll 17825300 against about 554000)
+if args.mc_counts == 'infofile' and args.verify_sample < 1:
+    parser.error('--mc_counts infofile needs --verify_sample of at least 1, infofile events are not checked against the files otherwise')
+
+# Byte ranges read from remote files are kept on disk, so repeat runs read them locally
+if not args.no_byte_cache:
+    hzz_cache.settings['directory'] = args.byte_cache
+    hzz_cache.settings['max_bytes'] = args.byte_cache_size*1e6
+
+# Files in the local mirror are read from disk instead of the web address
+hzz_mirror.settings['directory'] = None if args.no_mirror else args.mirror
+
 #===================================================================================
-# Remove current .pkl files
+# Remove current .pkl files and worker timings of the last run
 
 # Directory path
 directory = './data'
@@ -19,14 +56,21 @@ directory = './data'
 # List all files in the directory
 files = os.listdir(directory)
 
-# Filter files ending with '.pkl'
-pkl_files = [file for file in files if file.endswith('.pkl')]
+# Filter files ending with '.pkl', Parquet files, the manifest, timings written by the workers and files left half written
+pkl_files = [file for file in files if file.endswith('.pkl') or '.parquet' in file or file.endswith('.npz') or file.endswith('.tmp') or (file.startswith('timings_') and file.endswith('.json'))]
 
 # Remove each .pkl file
 for pkl_file in pkl_files:
     file_path = os.path.join(directory, pkl_file)
     os.remove(file_path)
 
+# Remove work queue of the last run
+queue_path = os.path.join(directory, 'queue')
+shutil.rmtree(queue_path, ignore_errors=True)
+
+# Remove ranks finished in the last run
+shutil.rmtree(hzz_handoff.finished_directory, ignore_errors=True)
+
 #===================================================================================
 # Where to access the input files
                                                                                                                                   
@@ -55,111 +99,173 @@ samples = {'data': {'list' : ['data_A','data_B','data_C','data_D'],
 # Data reading functions
 
 # Define function to read and process individual files
-def count_file(path,sample):
+def count_file(path,sample,verbose=True,cache=None):
 
     start = time.time() # start the clock
-    print("\tCounting: "+sample) # print which sample is being processed
-    # open the tree called mini using a context manager (will automatically close files/resources)
-    with uproot.open(path + ":mini") as tree:
-        numevents = tree.num_entries # number of events
-        count = numevents # number of events in this batch
- 
-        elapsed = time.time() - start # time taken to process
-        print("\t\t Count: "+str(count)+",\t in "+str(round(elapsed,1))+"s") # number of counts
+    if verbose: print("\tCounting: "+sample) # print which sample is being processed
+    if cache is None: cache = {} # nothing cached, always read the file
+    # get entry count and tree layout, only opening the file if it is not in the cache
+    metadata = hzz_metadata.get_metadata(path, cache, args.max_cache_age)
+    count = metadata['entries'] # number of events
+
+    elapsed = time.time() - start # time taken to process
+    if verbose: print("\t\t Count: "+str(count)+",\t in "+str(round(elapsed,1))+"s") # number of counts
     
-    return count # return array containing events passing all cuts
+    return count # return number of events in the file
+
+# Define function to get the path of a file, in the mirror if it has been mirrored
+def sample_path(s,val):
+    if s == 'data': prefix = "Data/" # Data prefix
+    else: # MC prefix
+        prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
+    return hzz_mirror.resolve(tuple_path, prefix+val+".4lep.root") # file name to open
+
+# Define function to count a file and time how long it took
+def time_count_file(path,sample,verbose=True,cache=None):
+    start = time.time() # start the clock
+    count = count_file(path,sample,verbose,cache) # call the function count_file defined above
+    return count, time.time() - start # return count and latency of this file
+
+# Define function to count a list of (sample, file, path) jobs, returning (count, latency) of each
+def count_jobs(jobs,concurrency=1,cache=None):
+    if concurrency > 1:
+        # Open up to 'concurrency' files at once, results come back in the same order as jobs
+        print('Counting '+str(len(jobs))+' files, '+str(concurrency)+' at a time')
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(lambda job: time_count_file(job[2], job[1], verbose=False, cache=cache), jobs))
+
+    results = []
+    previous = None
+    for s, val, fileString in jobs:
+        if s != previous:
+            print('Counting '+s+' samples') # print which sample
+            previous = s
+        results.append(time_count_file(fileString,val,cache=cache))
+    return results
 
 # Define function to get data from files
-def get_data_from_files():
+def get_data_from_files(concurrency=1,cache=None,mc_counts='remote',verify_sample=1):
 
-    counts = {} # define empty dictionary to hold awkward arrays
+    # List every file to be counted along with the sample it belongs to
+    jobs = []
     for s in samples: # loop over samples
-        dict = {}
-        print('Counting '+s+' samples') # print which sample
         for val in samples[s]['list']: # loop over each file
-            if s == 'data': prefix = "Data/" # Data prefix
-            else: # MC prefix
-                prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
-            fileString = tuple_path+prefix+val+".4lep.root" # file name to open
-            count = count_file(fileString,val) # call the function read_file defined below
-            dict[val] = count
-        counts[s] = dict
+            jobs.append((s, val, sample_path(s,val)))
+    mirrored = sum('://' not in job[2] for job in jobs)
+    if mirrored:
+        print(str(mirrored)+' of '+str(len(jobs))+' files read from the mirror in '+hzz_mirror.settings['directory'])
+
+    counted = {} # (count, latency) of each file opened
+    if mc_counts == 'infofile':
+        # Only open the data files, and a few MC files to check infofile against
+        mc_jobs = [job for job in jobs if job[0] != 'data']
+        checks = random.sample(mc_jobs, min(verify_sample, len(mc_jobs)))
+        to_open = [job for job in jobs if job[0] == 'data'] + checks
+        counted.update(zip([job[1] for job in to_open], count_jobs(to_open, concurrency, cache)))
+
+        mismatched = [val for _, val, _ in checks if counted[val][0] != infofile.infos[val]['events']]
+        if mismatched:
+            # infofile does not describe these files, so count the rest of MC properly
+            print('infofile failed verification, counting every MC file:')
+            for val in mismatched:
+                print('\t'+val+': '+str(counted[val][0])+' entries in the file, '+str(infofile.infos[val]['events'])+' events in infofile')
+            rest = [job for job in mc_jobs if job[1] not in counted]
+            counted.update(zip([job[1] for job in rest], count_jobs(rest, concurrency, cache)))
+        else:
+            print('infofile passed verification against '+', '.join(val for _, val, _ in checks)+', taking the other MC entries from infofile')
+    else:
+        counted.update(zip([job[1] for job in jobs], count_jobs(jobs, concurrency, cache)))
 
-    return counts # return dictionary of awkward arrays
+    counts = {} # define empty dictionary to hold counts
+    for s, val, _ in jobs:
+        if val in counted:
+            counts.setdefault(s, {})[val] = counted[val][0]
+        else:
+            counts.setdefault(s, {})[val] = infofile.infos[val]['events'] # not opened, taken from infofile
 
-#===================================================================================
+    # Report latency of each file and the total time spent waiting on files
+    print('========================================')
+    print('Latency per file:')
+    for s, val, _ in jobs:
+        if val in counted:
+            count, elapsed = counted[val]
+            print("\t"+val+":\t"+str(count)+" entries in "+str(round(elapsed,2))+"s")
+        else:
+            print("\t"+val+":\t"+str(counts[s][val])+" entries from infofile")
+    print("Sum of file latencies: "+str(round(sum(elapsed for _, elapsed in counted.values()),1))+"s")
+    print('========================================')
 
-# Define funciton to add nested dictionaries together
-def add_dictionaries(dict1, dict2):
-    result = {}
-    for key in dict1.keys():
-        if key in dict2:
-            if isinstance(dict1[key], dict) and isinstance(dict2[key], dict):
-                # Recursively call for nested dictionaries
-                result[key] = add_dictionaries(dict1[key], dict2[key])
-            else:
-                # Add values if they are not nested dictionaries
-                result[key] = dict1[key] + dict2[key]
+    return counts # return dictionary of counts
 
-    return result
+#===================================================================================
 
+# Define function to split every file into n equal parts, the first value % n parts getting
+# one extra entry. Start points are 1 more than the previous end point, except for the first.
 def split_dictionary(original_dict, n):
-    output_dicts = [{} for _ in range(n+1)]
-    zeros, ones = {},{}
-
-    for category, sub_dict in original_dict.items():
-        for key, value in sub_dict.items():
+    keys = [(category, key) for category, sub_dict in original_dict.items() for key in sub_dict]
+    values = np.array([original_dict[category][key] for category, key in keys], dtype=np.int64)
 
-            # Splitting the value into n parts
-            split_values = [value // n] * n  
-            remaining = value % n 
+    # (files x ranks) matrix of entries in each part
+    parts = np.repeat((values // n)[:, None], n, axis=1)
+    parts += np.arange(n)[None, :] < (values % n)[:, None]
 
-            # Distributing the remainder among the first 'remaining' dictionaries
-            for i in range(remaining):
-                split_values[i] += 1
+    # Make it cumulative, column i is the end of part i
+    boundaries = np.zeros((len(keys), n+1), dtype=np.int64)
+    np.cumsum(parts, axis=1, out=boundaries[:, 1:])
 
-            # Set initial dictionary of start points and create dictionary of 1s
-            zeros.setdefault(category, {})[key] = 0
-            ones.setdefault(category, {})[key] = 1
-
-            output_dicts[0] = zeros
-
-            # Assigning split values to output dictionaries
-            for i in range(1,n+1):
-                output_dicts[i].setdefault(category, {})[key] = split_values[i-1]
-    
-    # Make dictionaries cumulative
-    for i in range(1,n+1):
-        output_dicts[i] = add_dictionaries(output_dicts[i-1],output_dicts[i])
-
-    # Create start and end value dictionaries
-    start_dicts = output_dicts[:-1]
-    end_dicts = output_dicts[1:]
-
-    # Make start values 1 more than previous end values    
-    for i in range(1,n):
-        start_dicts[i] = add_dictionaries(start_dicts[i], ones)
-
-    # Final validation check to ensure all dictionaries add up to original
-    if output_dicts[n] == original_dict:
-        return start_dicts, end_dicts
-
-    else:
+    # Final validation check to ensure all parts add up to original
+    if not np.array_equal(boundaries[:, n], values):
         raise ValueError('End verification failed, split dictionaries do not add up to original')
 
+    starts = boundaries[:, :-1] + 1 # make start values 1 more than previous end values
+    starts[:, 0] = 0
+    ends = boundaries[:, 1:]
+    return hzz_planner.matrices_to_dictionaries(keys, starts, ends)
+
 def main():
 
     start = time.time() # time at start of whole processing
-    counts = get_data_from_files() # process all files
+    cache = {} if args.no_cache else hzz_metadata.load_cache() # metadata from previous runs
+    counts = get_data_from_files(args.concurrency, cache, args.mc_counts, args.verify_sample) # process all files
+    if not args.no_cache:
+        hzz_metadata.save_cache(cache) # keep metadata for the next run
     elapsed = time.time() - start # time after whole processing
     print("Time taken: "+str(round(elapsed,1))+"s") # print total time taken to process every file
+    if not args.no_byte_cache:
+        print(hzz_cache.summary())
 
     if float(args.number_workers).is_integer():
         n = int(args.number_workers)  # Number of output dictionaries
     else:
         raise ValueError('number of workers must be an integer')
 
-    start_dicts, end_dicts = split_dictionary(counts, n)
+    # basket layout of each file, read while counting, or just the entries of files not opened
+    metadata = {val: cache.get(sample_path(s,val), hzz_planner.entries_only_metadata(counts[s][val])) for s in counts for val in counts[s]}
+
+    # predicted seconds per entry of each file, from timings of earlier runs
+    cost = None
+    if args.cost_model is not None:
+        cost = hzz_planner.seconds_per_event(hzz_planner.load_cost_model(args.cost_model), metadata)
+
+    if args.schedule == 'dynamic':
+        # Tasks are taken off the queue while running, so no rank has a fixed range
+        tasks = hzz_planner.make_tasks(counts, metadata, args.task_size, args.cluster_tolerance, cost)
+        hzz_planner.write_task_queue(tasks, queue_path)
+        empty = {s: {val: [(0, 0)]*n for val in counts[s]} for s in counts}
+        start_dicts, end_dicts = hzz_planner.ranges_to_dictionaries(empty, n)
+    elif args.planner == 'equal':
+        start_dicts, end_dicts = split_dictionary(counts, n)
+    else:
+        if args.planner == 'affinity':
+            start_dicts, end_dicts = hzz_planner.affinity_split(counts, metadata, n, args.cluster_tolerance, cost)
+        else:
+            start_dicts, end_dicts = hzz_planner.cluster_split(counts, metadata, n, args.cluster_tolerance)
+        hzz_planner.report_duplicate_bytes(counts, metadata, split_dictionary(counts, n), (start_dicts, end_dicts))
+
+    if args.schedule == 'dynamic':
+        predicted = [None]*n # depends on which tasks each rank ends up taking
+    else:
+        predicted = hzz_planner.report_plan(counts, start_dicts, end_dicts, cost)
 
     #Printing the results
     print('========================================')
@@ -172,12 +278,20 @@ def main():
         print(f"Dictionary {i+1}: {output_dict}\n")
     print('========================================')
 
-    # Save dictionaries
-    with open('data/starts.pkl', 'wb') as sd:
+    # Save planner used and predicted time of each rank, for the run summary of the collector
+    with hzz_handoff.atomic_open('data/plan.json', 'w') as pf:
+        json.dump({'planner': args.planner, 'schedule': args.schedule, 'number_workers': n, 'predicted': predicted}, pf)
+
+    # Save start and end points as (files x ranks) matrices, which the workers load instead of the dictionaries
+    with hzz_handoff.atomic_open('data/manifest.npz') as mf:
+        hzz_planner.save_manifest(mf, *hzz_planner.dictionaries_to_matrices(counts, start_dicts, end_dicts))
+
+    # Save dictionaries, each is renamed into place once complete so the workers and collector can start straight away
+    with hzz_handoff.atomic_open('data/starts.pkl') as sd:
         pickle.dump(start_dicts, sd)
         print('start points saved')
     
-    with open('data/ends.pkl', 'wb') as ed:
+    with hzz_handoff.atomic_open('data/ends.pkl') as ed:
         pickle.dump(end_dicts, ed)
         print('end points saved')
 
@@ -0,0 +1,132 @@
+import uproot # for reading .root files
+import time # to timestamp cache entries
+import json # cache is stored as a json file so it survives the removal of .pkl files
+import os
+import argparse # for passing command line arguments
+import urllib.request # for checking remote file size and ETag
+
+import hzz_mirror # local file with the local copy of the sample files, memory mapping local files
+
+#===================================================================================
+# Define variables
+
+# Where the cache is kept, inside data so it is shared with the containers
+cache_path = 'data/metadata_cache.json'
+
+# Files on the ATLAS Open Data server never change, so cached entries are trusted for a week
+# before they are checked against the server again
+default_max_age = 7*24*60*60 # seconds
+
+# Branches read by the worker, basket boundaries are stored for each of these
+analysis_branches = ['lep_pt','lep_eta','lep_phi','lep_E','lep_charge','lep_type',
+                     'mcWeight','scaleFactor_PILEUP','scaleFactor_ELE','scaleFactor_MUON',
+                     'scaleFactor_LepTRIGGER']
+
+#===================================================================================
+# Cache reading and writing functions
+
+# Define function to load the cache from disk
+def load_cache(path=cache_path):
+    if not os.path.exists(path):
+        return {} # no cache yet
+    try:
+        with open(path, 'r') as cf:
+            return json.load(cf)
+    except (ValueError, OSError):
+        print('Metadata cache could not be read, starting with an empty cache')
+        return {}
+
+# Define function to save the cache to disk
+def save_cache(cache, path=cache_path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as cf:
+        json.dump(cache, cf)
+    os.replace(temp_path, path) # swap in complete file so a reader never sees half a cache
+
+# Define function to remove entries from the cache, every entry if no urls are given
+def invalidate(cache, urls=None):
+    if urls is None:
+        removed = len(cache)
+        cache.clear()
+    else:
+        removed = 0
+        for url in urls:
+            if cache.pop(url, None) is not None:
+                removed += 1
+    return removed # number of entries removed
+
+#===================================================================================
+# Metadata functions
+
+# Define function to get the validator of a file, its size and ETag if it has one
+def file_validator(path):
+    if '://' not in path: # local file
+        return {'size': os.path.getsize(path)}
+    request = urllib.request.Request(path, method='HEAD')
+    with urllib.request.urlopen(request, timeout=10) as response:
+        size = response.headers.get('Content-Length')
+        return {'size': int(size) if size is not None else None,
+                'etag': response.headers.get('ETag')}
+
+# Define function to read entry count, branch list and basket boundaries of a tree
+def read_tree_metadata(path):
+    # open the tree called mini using a context manager (will automatically close files/resources)
+    with uproot.open(path + ":mini", **hzz_mirror.open_options(path)) as tree:
+        branches = [name for name in analysis_branches if name in tree]
+        baskets = {}
+        for name in branches:
+            branch = tree[name]
+            baskets[name] = {'entry_offsets': [int(x) for x in branch.entry_offsets],
+                             'compressed_bytes': [int(branch.basket_compressed_bytes(i)) for i in range(branch.num_baskets)],
+                             'uncompressed_bytes': [int(branch.basket_uncompressed_bytes(i)) for i in range(branch.num_baskets)]}
+        return {'entries': int(tree.num_entries), # number of events
+                'branches': list(tree.keys()), # every branch in the tree
+                'clusters': [int(x) for x in tree.common_entry_offsets(filter_name=branches)], # entries where all baskets line up
+                'baskets': baskets}
+
+# Define function to get metadata of a file, from the cache when it is fresh enough
+def get_metadata(path, cache, max_age=default_max_age):
+    entry = cache.get(path)
+    if entry is not None:
+        if time.time() - entry['fetched'] < max_age:
+            return entry # fresh, no network needed
+        # Stale, only read the tree again if the file has changed on the server
+        try:
+            validator = file_validator(path)
+        except OSError:
+            validator = None
+        if validator is not None and validator == entry['validator']:
+            entry['fetched'] = time.time()
+            return entry
+
+    entry = read_tree_metadata(path)
+    try:
+        entry['validator'] = file_validator(path)
+    except OSError:
+        entry['validator'] = None # e.g. the server rejects HEAD, the entry is read again once it is stale
+    entry['fetched'] = time.time()
+    cache[path] = entry
+    return entry
+
+#===================================================================================
+# Command line interface for looking at and invalidating the cache
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows or invalidates the cached metadata of the input files')
+    parser.add_argument('--clear', action='store_true', help='Remove entries from the cache')
+    parser.add_argument('--url', action='append', help='Only remove this file from the cache, can be given more than once')
+    parser.add_argument('--cache', default=cache_path, help='Path of the cache file')
+    args = parser.parse_args()
+
+    cache = load_cache(args.cache)
+    if args.clear:
+        removed = invalidate(cache, args.url)
+        save_cache(cache, args.cache)
+        print(f'{removed} entries removed from {args.cache}')
+    else:
+        for url, entry in cache.items():
+            age = time.time() - entry['fetched']
+            print(f"{url}: {entry['entries']} entries, {len(entry['clusters'])-1} clusters, cached {round(age/3600,1)}h ago")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import bisect # for finding which basket an entry is in
+import json # cost model is stored as json
+import os
+import numpy as np # for the (files x ranks) matrices of start and end points
+
+#===================================================================================
+# Planning functions, these work on the metadata stored by hzz_metadata
+#
+# Every plan is a list of n (start, stop) entry ranges per file, where rank i reads
+# entries start <= entry < stop. Ranges are written to starts.pkl/ends.pkl as
+# start and stop-1, as hzz_script reads up to and including the end point.
+
+# Define function to make metadata for a file that has not been opened, with nothing known
+# about its baskets so cuts are made at the equal split
+def entries_only_metadata(entries):
+    return {'entries': entries, 'clusters': [0, entries], 'baskets': {}}
+
+# Define function to find the baskets of a branch that hold entries start <= entry < stop
+def baskets_in_range(offsets, start, stop):
+    if stop <= start:
+        return range(0) # empty range reads nothing
+    first = bisect.bisect_right(offsets, start) - 1
+    last = bisect.bisect_left(offsets, stop) - 1
+    return range(max(first, 0), min(last + 1, len(offsets) - 1))
+
+# Define function to get the bytes of baskets that would be read by both sides of a cut
+def cut_cost(metadata, cut):
+    cost = 0
+    for branch in metadata['baskets'].values():
+        offsets = branch['entry_offsets']
+        k = bisect.bisect_right(offsets, cut) - 1
+        if 0 <= k < len(offsets) - 1 and offsets[k] < cut:
+            cost += branch['compressed_bytes'][k] # cut falls inside this basket
+    return cost
+
+# Define function to count bytes read more than once by a list of (start, stop) ranges
+def duplicate_bytes(metadata, ranges):
+    duplicated = 0
+    for branch in metadata['baskets'].values():
+        times_read = [0]*len(branch['compressed_bytes'])
+        for start, stop in ranges:
+            for k in baskets_in_range(branch['entry_offsets'], start, stop):
+                times_read[k] += 1
+        duplicated += sum(size*(reads-1) for size, reads in zip(branch['compressed_bytes'], times_read) if reads > 1)
+    return duplicated
+
+# Define function to place n-1 cuts in a file, each on the basket boundary closest to
+# an equal split that costs the fewest bytes read twice
+def aligned_boundaries(metadata, n, tolerance=0.1):
+    total = metadata['entries']
+    candidates = set(metadata['clusters'])
+    for branch in metadata['baskets'].values():
+        candidates.update(branch['entry_offsets'])
+    candidates = sorted(c for c in candidates if 0 <= c <= total)
+
+    boundaries = [0]
+    window = max(1, int(tolerance*total/n)) # how far a cut can move from the equal split
+    for i in range(1, n):
+        ideal = (total*i)//n
+        lo = bisect.bisect_left(candidates, ideal - window)
+        hi = bisect.bisect_right(candidates, ideal + window)
+        nearby = [c for c in candidates[lo:hi] if c >= boundaries[-1]]
+        if nearby:
+            # cheapest cut first, then the one closest to the equal split
+            cut = min(nearby, key=lambda c: (cut_cost(metadata, c), abs(c - ideal)))
+        else:
+            cut = max(ideal, boundaries[-1]) # no basket boundary close enough, cut at the equal split
+        boundaries.append(cut)
+    boundaries.append(total)
+    return boundaries
+
+# Define function to convert the ranges of each file into start and end dictionaries
+def ranges_to_dictionaries(ranges, n):
+    start_dicts = [{} for _ in range(n)]
+    end_dicts = [{} for _ in range(n)]
+    for category, sub_dict in ranges.items():
+        for key, file_ranges in sub_dict.items():
+            for i, (start, stop) in enumerate(file_ranges):
+                start_dicts[i].setdefault(category, {})[key] = start
+                end_dicts[i].setdefault(category, {})[key] = stop - 1 # workers read up to and including the end
+    return start_dicts, end_dicts
+
+# Define function to convert (files x ranks) matrices of start and end points into dictionaries
+def matrices_to_dictionaries(keys, starts, ends):
+    n = starts.shape[1]
+    start_dicts = [{} for _ in range(n)]
+    end_dicts = [{} for _ in range(n)]
+    starts, ends = starts.tolist(), ends.tolist() # python ints for the dictionaries
+    for j, (category, key) in enumerate(keys):
+        for i in range(n):
+            start_dicts[i].setdefault(category, {})[key] = starts[j][i]
+            end_dicts[i].setdefault(category, {})[key] = ends[j][i]
+    return start_dicts, end_dicts
+
+# Define function to convert start and end dictionaries into (files x ranks) matrices
+def dictionaries_to_matrices(original_dict, start_dicts, end_dicts):
+    keys = [(category, key) for category, sub_dict in original_dict.items() for key in sub_dict]
+    starts = np.array([[sd[category][key] for sd in start_dicts] for category, key in keys], dtype=np.int64)
+    ends = np.array([[ed[category][key] for ed in end_dicts] for category, key in keys], dtype=np.int64)
+    return keys, starts, ends
+
+# Define function to save start and end points as a compact manifest, one column per rank
+def save_manifest(path, keys, starts, ends):
+    np.savez_compressed(path,
+                        categories=np.array([category for category, _ in keys]),
+                        samples=np.array([key for _, key in keys]),
+                        starts=starts, ends=ends)
+
+# Define function to convert start and end dictionaries back into (start, stop) ranges of one file
+def dictionaries_to_ranges(start_dicts, end_dicts, category, key, total):
+    return [(min(sd[category][key], total), min(ed[category][key] + 1, total)) for sd, ed in zip(start_dicts, end_dicts)]
+
+# Define function to check the ranges of every file cover it exactly once
+def check_ranges(ranges, original_dict):
+    for category, sub_dict in ranges.items():
+        for key, file_ranges in sub_dict.items():
+            pieces = sorted(r for r in file_ranges if r[1] > r[0]) # ranges that read something
+            position = 0
+            for start, stop in pieces:
+                if start != position:
+                    raise ValueError(f'End verification failed, ranges of {key} do not cover the original')
+                position = stop
+            if position != original_dict[category][key]:
+                raise ValueError(f'End verification failed, ranges of {key} do not cover the original')
+
+# Define function to split every file into n ranges cut on basket boundaries
+def cluster_split(original_dict, metadata, n, tolerance=0.1):
+    ranges = {}
+    for category, sub_dict in original_dict.items():
+        for key, value in sub_dict.items():
+            boundaries = aligned_boundaries(metadata[key], n, tolerance)
+            ranges.setdefault(category, {})[key] = list(zip(boundaries[:-1], boundaries[1:]))
+
+    # Final validation check to ensure every file is covered exactly once
+    check_ranges(ranges, original_dict)
+
+    return ranges_to_dictionaries(ranges, n)
+
+# Define function to move a cut inside a file to the cheapest basket boundary nearby
+def snap_cut(metadata, cut, low, window):
+    total = metadata['entries']
+    if cut <= low or cut >= total:
+        return min(max(cut, low), total) # cut is at the edge of the file, nothing to snap
+    candidates = set(metadata['clusters'])
+    for branch in metadata['baskets'].values():
+        candidates.update(branch['entry_offsets'])
+    nearby = [c for c in candidates if low <= c <= total and abs(c - cut) <= window]
+    if not nearby:
+        return cut
+    return min(nearby, key=lambda c: (cut_cost(metadata, c), abs(c - cut)))
+
+# Define function to give whole files to single ranks and split only the files too big to fit,
+# balancing the cost of each rank where cost is seconds per entry of each file (entries if not given)
+def affinity_split(original_dict, metadata, n, tolerance=0.1, cost=None):
+    if cost is None:
+        cost = {key: 1 for sub_dict in original_dict.values() for key in sub_dict}
+    files = [(category, key, value) for category, sub_dict in original_dict.items() for key, value in sub_dict.items()]
+    total = sum(value*cost[key] for _, key, value in files)
+
+    # Cost each rank should get
+    capacity = [total/n]*n
+
+    ranges = {category: {key: [(0, 0)]*n for key in sub_dict} for category, sub_dict in original_dict.items()}
+
+    # Most costly files first, each goes whole to the rank with most room left if it fits there
+    to_split = []
+    for category, key, value in sorted(files, key=lambda f: -f[2]*cost[f[1]]):
+        i = max(range(n), key=lambda r: capacity[r])
+        if value*cost[key] <= capacity[i]*(1 + 1e-9):
+            ranges[category][key] = [(0, value) if r == i else (0, 0) for r in range(n)]
+            capacity[i] -= value*cost[key]
+        else:
+            to_split.append((category, key, value))
+
+    # Lay the remaining files end to end and cut them where each rank is full,
+    # so each split file is read by a run of neighbouring ranks
+    to_split.sort(key=lambda f: [k for _, k, _ in files].index(f[1])) # keep sample order
+    f, position = 0, 0 # file being cut and entry it has been cut up to
+    target, taken = 0, 0 # cost of the split files each rank should have reached, and has been given out
+    for r in range(n):
+        target += capacity[r]
+        while f < len(to_split) and (taken < target or r == n-1):
+            category, key, value = to_split[f]
+            stop = position + int(round((target - taken)/cost[key]))
+            if r == n-1 or stop >= value:
+                stop = value # rest of the file, the last rank takes whatever is left
+            else:
+                window = max(1, int(tolerance*total/n/cost[key])) # how far a cut can move to reach a basket boundary
+                stop = snap_cut(metadata[key], stop, position, window)
+            if stop > position:
+                ranges[category][key][r] = (position, stop)
+            taken += (stop - position)*cost[key]
+            if stop >= value:
+                f, position = f + 1, 0 # move on to the next file
+            else:
+                position = stop
+                break # rank is full part way through this file
+
+    # Final validation check to ensure every file is covered exactly once
+    check_ranges(ranges, original_dict)
+
+    return ranges_to_dictionaries(ranges, n)
+
+# Define function to print the entries and file opens of each rank in a plan, and the
+# predicted time of each rank if a cost is given
+def report_plan(original_dict, start_dicts, end_dicts, cost=None):
+    print('Entries and file opens per rank:')
+    total_opens = 0
+    predicted = []
+    for i, (sd, ed) in enumerate(zip(start_dicts, end_dicts)):
+        entries, opens, seconds = 0, 0, 0
+        for category, sub_dict in original_dict.items():
+            for key, value in sub_dict.items():
+                start, stop = min(sd[category][key], value), min(ed[category][key] + 1, value)
+                if stop > start:
+                    entries += stop - start
+                    opens += 1
+                    if cost is not None:
+                        seconds += (stop - start)*cost[key]
+        total_opens += opens
+        predicted.append(seconds if cost is not None else None)
+        if cost is not None:
+            print(f'\trank {i}:\t {entries} entries,\t {opens} files,\t predicted {round(seconds,1)}s')
+        else:
+            print(f'\trank {i}:\t {entries} entries,\t {opens} files')
+    print(f'Total file opens: {total_opens}')
+    return predicted # predicted seconds of each rank
+
+# Define function to print bytes read twice by two plans
+def report_duplicate_bytes(original_dict, metadata, old_plan, new_plan):
+    print('Bytes read by more than one rank:')
+    old_total, new_total = 0, 0
+    for category, sub_dict in original_dict.items():
+        for key, value in sub_dict.items():
+            old = duplicate_bytes(metadata[key], dictionaries_to_ranges(*old_plan, category, key, value))
+            new = duplicate_bytes(metadata[key], dictionaries_to_ranges(*new_plan, category, key, value))
+            old_total += old
+            new_total += new
+            print(f'\t{key}:\t equal split {old} bytes,\t aligned split {new} bytes')
+    print(f'Total:\t equal split {old_total} bytes,\t aligned split {new_total} bytes')
+
+#===================================================================================
+# Work queue functions
+#
+# With dynamic scheduling every file is cut into many small tasks, written as one json
+# file each to queue/todo. Workers claim tasks by renaming them into queue/claimed,
+# so an idle worker just takes the next task instead of waiting on a fixed range.
+
+# Define function to cut every file into tasks of about task_size entries on basket boundaries
+def make_tasks(original_dict, metadata, task_size, tolerance=0.1, cost=None):
+    tasks = []
+    for category, sub_dict in original_dict.items():
+        for key, value in sub_dict.items():
+            k = max(1, -(-value//task_size)) # number of tasks, rounded up
+            boundaries = aligned_boundaries(metadata[key], k, tolerance)
+            for start, stop in zip(boundaries[:-1], boundaries[1:]):
+                if stop > start:
+                    tasks.append({'category': category, 'sample': key, 'start': start, 'stop': stop})
+
+    # Most costly tasks first, so the small ones fill in the gaps at the end of the run
+    c = cost if cost is not None else {}
+    tasks.sort(key=lambda t: -(t['stop'] - t['start'])*c.get(t['sample'], 1))
+
+    # Final validation check to ensure every file is covered exactly once
+    ranges = {}
+    for t in tasks:
+        ranges.setdefault(t['category'], {}).setdefault(t['sample'], []).append((t['start'], t['stop']))
+    check_ranges(ranges, {category: {key: value for key, value in sub_dict.items() if value > 0} for category, sub_dict in original_dict.items()})
+
+    return tasks
+
+# Define function to write tasks to the work queue
+def write_task_queue(tasks, queue_path):
+    todo = os.path.join(queue_path, 'todo')
+    os.makedirs(todo)
+    os.makedirs(os.path.join(queue_path, 'claimed'))
+    for i, task in enumerate(tasks):
+        temp_path = os.path.join(queue_path, f'{i:06d}.tmp')
+        with open(temp_path, 'w') as tf:
+            json.dump(task, tf)
+        os.rename(temp_path, os.path.join(todo, f'{i:06d}.json')) # task only appears once it is complete
+    print(f'{len(tasks)} tasks written to {todo}')
+
+#===================================================================================
+# Cost model functions
+#
+# The cost model is written by hzz_collector from the timings of each worker, and holds
+# for each sample the seconds and compressed bytes read per event
+
+# Define function to load the cost model
+def load_cost_model(path):
+    if not os.path.exists(path):
+        print(f'No cost model at {path}, balancing entries instead')
+        return {}
+    with open(path, 'r') as cm:
+        return json.load(cm)
+
+# Define function to get compressed bytes per event of the branches the worker reads
+def bytes_per_event(metadata):
+    if metadata['entries'] == 0:
+        return 0
+    return sum(sum(branch['compressed_bytes']) for branch in metadata['baskets'].values())/metadata['entries']
+
+# Define function to get predicted seconds per entry of each file, None if nothing has been timed
+def seconds_per_event(cost_model, metadata):
+    # Bytes processed per second over every sample that has been timed, used for files not timed yet
+    timed = [c for c in cost_model.values() if c.get('seconds_per_event')]
+    if not timed:
+        return None # balance entries
+    throughput = sum(c['bytes_per_event'] for c in timed)/sum(c['seconds_per_event'] for c in timed)
+
+    cost = {}
+    for key, file_metadata in metadata.items():
+        if key in cost_model and cost_model[key].get('seconds_per_event'):
+            cost[key] = cost_model[key]['seconds_per_event'] # measured on earlier runs
+        elif bytes_per_event(file_metadata) > 0:
+            cost[key] = bytes_per_event(file_metadata)/throughput # estimated from its size
+        else:
+            cost[key] = sum(c['seconds_per_event'] for c in timed)/len(timed) # nothing known about it, use the average
+    return cost
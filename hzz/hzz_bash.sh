@@ -12,29 +12,41 @@ run_worker() {
     python worker/hzz_script.py --rank $rank
 }
 
-# Get input argument
+# Get input arguments
 n=$1
+schedule=${2:-static}
+fan_in=${3:-0}
 
 # Check if the number of arguments is correct
-if [ "$#" -ne 1 ]; then
-    echo "Usage: $0 <number_of_workers>"
+if [ "$#" -lt 1 ] || [ "$#" -gt 3 ]; then
+    echo "Usage: $0 <number_of_workers> [static|dynamic] [fan_in]"
     exit 1
 fi
 
 # Run the counter script
-python counter/hzz_counter.py --number_workers $n
+python counter/hzz_counter.py --number_workers $n --schedule $schedule
+
+# Run the reducers of the reduction tree, which merge ranks as they finish
+if [ "$fan_in" -gt 1 ]; then
+    python worker/hzz_reducer.py --fan_in $fan_in &
+fi
 
 # Run worker scripts with ranks 0 to n-1
 for ((rank=0; rank<n; rank++)); do
-    run_worker $rank
+    if [ "$schedule" == "dynamic" ]; then
+        run_worker $rank & # workers share the work queue, so run them at the same time
+    else
+        run_worker $rank
+    fi
 done
+wait
 
 # Run the collector script
-python collector/hzz_collector.py
+python collector/hzz_collector.py --fan_in $fan_in
 
 # Record end time when plot is actually produced
 while [ ! -f data/graph.png ]; do
-    sleep 1
+    sleep 0.1
 done
 end_time=$(date +%s)
 
@@ -9,7 +9,7 @@ start_time=$(date +%s)
 # Function to build counter container
 build_counter() {
     docker build -t counter_image ./counter/
-    docker run --name counter_container -v "./data:/app/data" counter_image python hzz_counter.py --number_workers "$1"
+    docker run --name counter_container -v "./data:/app/data" counter_image python hzz_counter.py --number_workers "$1" --schedule "$2"
 }
 
 # Function to build worker containers
@@ -29,13 +29,13 @@ build_collector() {
 # Main function
 main() {
     # Check if the number of arguments is correct
-    if [ "$#" -ne 1 ]; then
-        echo "Usage: $1 <number_of_workers>"
+    if [ "$#" -lt 1 ] || [ "$#" -gt 2 ]; then
+        echo "Usage: $0 <number_of_workers> [static|dynamic]"
         exit 1
     fi
 
     # Build counter container
-    build_counter "$1"
+    build_counter "$1" "${2:-static}"
 
     # Build worker containers
     build_worker "$(( $1 - 1 ))"
@@ -49,7 +49,7 @@ main "$@"
 
 # Record end time when plot is actually produced
 while [ ! -f data/graph.png ]; do
-    sleep 1
+    sleep 0.1
 done
 end_time=$(date +%s)
 
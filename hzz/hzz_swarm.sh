@@ -2,6 +2,12 @@
 # Run on manager node only!
 ###########################
 
+# Scheduling of work between workers, static or dynamic
+schedule=${1:-static}
+
+# Fan-in of the reduction tree merging results on the worker nodes before the collector, 0 for no tree
+fan_in=${2:-0}
+
 # Get the number of worker nodes
 n=$(( $(docker node ls | grep -vc "Leader") - 1 ))
 echo "$n worker nodes"
@@ -17,13 +23,32 @@ docker volume create --driver local --opt type=none --opt device=./data --opt o=
 # Create collector and counter service on just manager node
 manager_id=$(docker node ls | grep -n "Leader" | awk '{print $1}' | cut -d ':' -f 2)
 
-docker service create --name counter --constraint "node.id==$manager_id" --mount type=volume,source=shared_volume,target=/app/data counter_image python hzz_counter.py --number_workers n
-docker service create --name collector --constraint "node.id==$manager_id" --mount type=volume,source=shared_volume,target=/app/data collector_image python hzz_collector.py
+docker service create --name counter --constraint "node.id==$manager_id" --mount type=volume,source=shared_volume,target=/app/data counter_image python hzz_counter.py --number_workers $n --schedule $schedule
+docker service create --name collector --constraint "node.id==$manager_id" --mount type=volume,source=shared_volume,target=/app/data collector_image python hzz_collector.py --fan_in $fan_in
 
 # Create service for relevant rank on each worker node
 for ((i = 0; i < n; i++)); do
 
     worker_id=$(docker node ls | grep -nv "Leader" | sed -n "$((i+1))p" | awk '{print $1}' | cut -d ':' -f 2)
-    docker service create --name worker_$i --constraint "node.id==$worker_id" --mount type=volume,source=shared_data,target=/app/data worker_image python hzz_script.py --rank $i
+    docker service create --name worker_$i --constraint "node.id==$worker_id" --mount type=volume,source=shared_volume,target=/app/data worker_image python hzz_script.py --rank $i
 
 done
+
+# Create a service for each reducer of the reduction tree, on the node of the first rank it covers
+if [ "$fan_in" -gt 1 ]; then
+    size=$n # outputs at the level below
+    span=1 # ranks covered by each output of the level below
+    level=1
+    while [ "$size" -gt "$fan_in" ]; do
+        size=$(( (size + fan_in - 1) / fan_in ))
+        for ((j = 0; j < size; j++)); do
+
+            first_rank=$(( j * span * fan_in ))
+            worker_id=$(docker node ls | grep -nv "Leader" | sed -n "$((first_rank+1))p" | awk '{print $1}' | cut -d ':' -f 2)
+            docker service create --name reducer_${level}_$j --constraint "node.id==$worker_id" --mount type=volume,source=shared_volume,target=/app/data worker_image python hzz_reducer.py --fan_in $fan_in --level $level --index $j
+
+        done
+        span=$(( span * fan_in ))
+        level=$(( level + 1 ))
+    done
+fi
@@ -0,0 +1,197 @@
+import awkward as ak # to represent nested data in columnar format
+import numpy as np
+import time # to measure time taken
+import tracemalloc # to measure peak memory, numpy and awkward buffers are tracked
+import argparse # for passing command line arguments
+import os
+import pickle
+import tempfile # for the files written by the writer benchmark
+from concurrent.futures import ThreadPoolExecutor # to write chunks from several threads, as with --pool_size
+
+from hzz_cuts import calc_mllll, calc_weight, cut_lep_charge, cut_lep_type, selection_mask, dense_cut_weight_mass # local file containing cuts and mass calculation
+import hzz_numba # local file with the compiled cut and weight kernel
+import hzz_histograms # local file with the m4l histograms shared with the collector
+import hzz_writer # local file with the Parquet writer of --output parquet
+
+#===================================================================================
+# Micro-benchmarks of the worker's per-chunk steps on synthetic 4lep chunks, run with e.g.
+#   python worker/hzz_benchmark.py selection --events 100000
+
+#===================================================================================
+# Synthetic data
+
+# Define function to make a chunk shaped like the output of tree.iterate in hzz_script.read_file
+def make_chunk(n_events, seed=0):
+    rng = np.random.default_rng(seed)
+    n_leptons = rng.choice([4, 4, 4, 4, 5, 6], n_events) # mostly exactly 4 leptons, some more
+    n_total = int(n_leptons.sum())
+
+    def jagged(values):
+        return ak.unflatten(values, n_leptons)
+
+    pt = rng.uniform(7e3, 1e5, n_total)
+    eta = rng.uniform(-2.5, 2.5, n_total)
+    return ak.zip({'lep_pt': jagged(pt.astype(np.float32)),
+                   'lep_eta': jagged(eta.astype(np.float32)),
+                   'lep_phi': jagged(rng.uniform(-np.pi, np.pi, n_total).astype(np.float32)),
+                   'lep_E': jagged(np.sqrt((pt*np.cosh(eta))**2 + 105.7**2).astype(np.float32)), # muon mass, in MeV
+                   'lep_charge': jagged(rng.choice([-1, 1], n_total).astype(np.int32)),
+                   'lep_type': jagged(rng.choice([11, 13], n_total).astype(np.uint32)),
+                   'mcWeight': rng.normal(1, 0.1, n_events).astype(np.float32),
+                   'scaleFactor_PILEUP': rng.normal(1, 0.05, n_events).astype(np.float32),
+                   'scaleFactor_ELE': rng.normal(1, 0.05, n_events).astype(np.float32),
+                   'scaleFactor_MUON': rng.normal(1, 0.05, n_events).astype(np.float32),
+                   'scaleFactor_LepTRIGGER': rng.normal(1, 0.05, n_events).astype(np.float32)},
+                  depth_limit=1) # one record per event, as read from the tree
+
+#===================================================================================
+# Measuring functions
+
+# Define function to time a step and measure the peak memory it allocates
+def measure(step, data, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        step(data)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = step(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, min(times), peak
+
+# Define function to check two results are the same
+def same_result(result, reference):
+    return ak.to_list(result) == ak.to_list(reference)
+
+# Define function to run each step on the same chunk, check they agree and print the comparison
+def compare(steps, data, repeats, agree=same_result, unit='events'):
+    print(f'{len(data)} {unit}, best of {repeats}:')
+    results = {}
+    for name, step in steps.items():
+        result, seconds, peak = measure(step, data, repeats)
+        results[name] = (result, seconds, peak)
+        print(f'\t{name}:\t {round(seconds*1000, 2)} ms,\t peak {round(peak/1e6, 2)} MB')
+
+    names = list(results)
+    reference = results[names[0]][0]
+    for name in names[1:]:
+        if not agree(results[name][0], reference):
+            raise ValueError(f'{name} does not give the same result as {names[0]}')
+        print(f'{name} against {names[0]}:\t {round(results[names[0]][1]/results[name][1], 2)}x faster,\t '
+              f'{round((results[names[0]][2] - results[name][2])/1e6, 2)} MB less peak memory')
+
+#===================================================================================
+# Benchmarks
+
+# Selection step: two filters, each copying the whole record, against one combined mask
+def benchmark_selection(data, repeats):
+    def two_filters(data):
+        data = data[~cut_lep_charge(data.lep_charge)]
+        data = data[~cut_lep_type(data.lep_type)]
+        return ak.to_packed(data) # make the copies as pickling the output would
+
+    def fused_mask(data):
+        return ak.to_packed(data[selection_mask(data.lep_charge, data.lep_type)])
+
+    compare({'two filters': two_filters, 'fused mask': fused_mask}, data, repeats)
+
+# Cuts, weight and mass: the jagged awkward functions against dense (events x 4) arrays and the compiled kernel
+def benchmark_kernel(data, repeats):
+    xsec_weight = 0.01
+
+    def jagged(data):
+        data = data[selection_mask(data.lep_charge, data.lep_type)]
+        data['totalWeight'] = calc_weight(xsec_weight, data)
+        data['mllll'] = calc_mllll(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+        return data
+
+    def dense(data):
+        return dense_cut_weight_mass(data, xsec_weight)
+
+    def compiled(data):
+        return hzz_numba.cut_weight_mass(data, xsec_weight)
+
+    steps = {'jagged': jagged, 'dense': dense}
+    if hzz_numba.available:
+        compiled(data[:10]) # compile before timing
+        steps['numba'] = compiled
+    else:
+        print('numba is not installed, leaving it out')
+    compare(steps, data, repeats)
+
+# m4l histogram: np.histogram searching the bin edges for counts, weights and squared weights, against
+# working out the bins once from the fixed bin width and adding up with np.bincount
+def benchmark_histogram(data, repeats):
+    data = dense_cut_weight_mass(data, 0.01) # events with masses and weights to histogram
+
+    def searched(data):
+        mllll, weights = np.asarray(ak.to_numpy(data.mllll), dtype=np.float64), ak.to_numpy(data.totalWeight).astype(np.float64)
+        return {'counts': np.histogram(mllll, bins=hzz_histograms.bin_edges)[0],
+                'sumw': np.histogram(mllll, bins=hzz_histograms.bin_edges, weights=weights)[0],
+                'sumw2': np.histogram(mllll, bins=hzz_histograms.bin_edges, weights=weights**2)[0]}
+
+    def fixed_width(data):
+        return hzz_histograms.fill_histogram(hzz_histograms.empty_histogram(), ak.to_numpy(data.mllll), ak.to_numpy(data.totalWeight))
+
+    # same counts, sums the same to float64 rounding
+    def agree(result, reference):
+        return (np.array_equal(result['counts'], reference['counts'])
+                and all(np.allclose(result[key], reference[key], rtol=1e-12, atol=0) for key in ['sumw','sumw2']))
+
+    compare({'np.histogram': searched, 'fixed width': fixed_width}, data, repeats, agree)
+
+# Saving a rank's events: pickling every chunk at the end of the run (--output events) against writing each
+# chunk to Parquet as it is made (--output parquet), in one thread and from a pool of threads. MC chunks are
+# written before real data, which has no totalWeight, and every way must give the collector the same histograms
+def benchmark_writer(data, repeats):
+    data = dense_cut_weight_mass(data, 0.01)[['mllll','totalWeight']] # the columns saved by default
+    samples = {'data': {'list': ['data_A']}, 'MC': {'list': ['llll']}}
+    size = -(-len(data)//8)
+    chunks = [('llll', data[i:i+size]) for i in range(0, len(data)//2, size)]
+    chunks += [('data_A', data[i:i+size][['mllll']]) for i in range(len(data)//2, len(data), size)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        def pickled(chunks):
+            path = os.path.join(directory, 'data_0.pkl')
+            with open(path, 'wb') as d:
+                pickle.dump({'data': ak.concatenate([chunk for sample, chunk in chunks if sample == 'data_A']),
+                             'MC': ak.concatenate([chunk for sample, chunk in chunks if sample == 'llll'])}, d)
+            return hzz_histograms.saved_histograms(path, samples)
+
+        def parquet(chunks, pool_size=1):
+            path = os.path.join(directory, 'data_0.parquet')
+            writer = hzz_writer.RankWriter(path)
+            with ThreadPoolExecutor(max_workers=pool_size) as pool:
+                list(pool.map(lambda chunk: writer.write(*chunk), chunks)) # finishing in any order with more than one thread
+            writer.close()
+            return hzz_histograms.saved_histograms(path, samples)
+
+        # same counts, sums the same to float64 rounding (chunks can be added up in a different order)
+        def agree(result, reference):
+            return all(np.array_equal(result[s]['counts'], reference[s]['counts'])
+                       and all(np.allclose(result[s][key], reference[s][key], rtol=1e-12, atol=0) for key in ['sumw','sumw2'])
+                       for s in samples)
+
+        steps = {'pickle': pickled}
+        if hzz_writer.available:
+            steps['parquet'] = parquet
+            steps['parquet, 4 threads'] = lambda chunks: parquet(chunks, 4)
+        else:
+            print('pyarrow is not installed, leaving out parquet')
+        compare(steps, chunks, repeats, agree, f'chunks of up to {size} events')
+
+benchmarks = {'selection': benchmark_selection, 'kernel': benchmark_kernel, 'histogram': benchmark_histogram, 'writer': benchmark_writer}
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the per-chunk steps of the worker on synthetic 4lep chunks')
+    parser.add_argument('benchmark', choices=list(benchmarks), help='Which step to benchmark')
+    parser.add_argument('--events', default=100000, type=int, help='Events in the synthetic chunk')
+    parser.add_argument('--repeats', default=5, type=int, help='Number of times each step is timed')
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](make_chunk(args.events), args.repeats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import awkward as ak # to represent nested data in columnar format
+import numpy as np
+import vector # for 4-momentum calculations
+
+#===================================================================================
+# Selection, weight and mass functions of the analysis, kept apart from hzz_script so they
+# can be imported without starting a worker (e.g. by hzz_benchmark)
+
+# Set units
+MeV = 0.001
+GeV = 1.0
+
+def calc_mllll(lep_pt, lep_eta, lep_phi, lep_E):
+    # construct awkward 4-vector array
+    p4 = vector.zip({"pt": lep_pt, "eta": lep_eta, "phi": lep_phi, "E": lep_E})
+    # calculate invariant mass of first 4 leptons
+    # [:, i] selects the i-th lepton in each event
+    # .M calculates the invariant mass
+    return (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M * MeV
+
+#===================================================================================
+# Weight functions
+
+# Define function to calculate weight of MC event
+def calc_weight(xsec_weight, events):
+    return (xsec_weight * events.mcWeight * events.scaleFactor_PILEUP * events.scaleFactor_ELE * events.scaleFactor_MUON * events.scaleFactor_LepTRIGGER)
+
+#===================================================================================
+# Cut functions
+
+# cut on lepton charge
+# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
+def cut_lep_charge(lep_charge):
+# throw away when sum of lepton charges is not equal to 0
+# first lepton in each event is [:, 0], 2nd lepton is [:, 1] etc
+    return lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
+
+
+# cut on lepton type
+# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
+def cut_lep_type(lep_type):
+# for an electron lep_type is 11
+# for a muon lep_type is 13
+# throw away when none of eeee, mumumumu, eemumu
+    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
+    return (sum_lep_type != 44) & (sum_lep_type != 48) & (sum_lep_type != 52)
+
+
+# offsets of each event into the flat lepton buffer, and the buffer itself
+def lepton_buffers(lep_values):
+    layout = ak.to_layout(lep_values)
+    if not isinstance(layout, (ak.contents.ListOffsetArray, ak.contents.ListArray)):
+        layout = ak.to_layout(ak.to_packed(lep_values)) # e.g. a filtered record field, pack it first
+    layout = layout.to_ListOffsetArray64(True)
+    offsets = np.asarray(layout.offsets)
+    if np.any(offsets[1:] - offsets[:-1] < 4):
+        raise ValueError('every event needs at least 4 leptons')
+    return offsets, np.asarray(layout.content.data)
+
+
+# sum of the first 4 leptons of each event, read straight from the flat lepton buffer
+# rather than through 4 jagged [:, i] selections
+def sum_first_four(lep_values):
+    offsets, content = lepton_buffers(lep_values)
+    starts = offsets[:-1]
+    return content[starts] + content[starts+1] + content[starts+2] + content[starts+3]
+
+
+# both cuts at once, gives True for events to keep so a chunk only has to be filtered once
+def selection_mask(lep_charge, lep_type):
+    sum_lep_charge = sum_first_four(lep_charge)
+    sum_lep_type = sum_first_four(lep_type)
+    return (sum_lep_charge == 0) & ((sum_lep_type == 44) | (sum_lep_type == 48) | (sum_lep_type == 52))
+
+#===================================================================================
+# Dense versions, working on (n_events, 4) NumPy arrays of the first 4 leptons of each event
+
+# position of the first 4 leptons of each event in the flat lepton buffer, as an (n_events, 4) array,
+# leptons after the 4th are left out
+def first_four_index(offsets):
+    index = np.empty((len(offsets) - 1, 4), dtype=offsets.dtype)
+    for i in range(4):
+        index[:, i] = offsets[:-1] + i
+    return index
+
+
+# first 4 leptons of each event as an (n_events, 4) array
+def first_four(lep_values):
+    offsets, content = lepton_buffers(lep_values)
+    return content[first_four_index(offsets)]
+
+
+# both cuts at once on dense charge and type arrays, gives True for events to keep
+def dense_selection_mask(lep_charge, lep_type):
+    sum_lep_charge = lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3]
+    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
+    return (sum_lep_charge == 0) & ((sum_lep_type == 44) | (sum_lep_type == 48) | (sum_lep_type == 52))
+
+
+# add two 4-vectors given as pt, phi, eta, E, the same NumPy steps vector takes to add them
+def add_rhophi_eta_t(rho1, phi1, eta1, t1, rho2, phi2, eta2, t2):
+    diff = phi2 - phi1
+    u = rho2 * np.cos(diff)
+    v = rho2 * np.sin(diff)
+    rho = np.sqrt((rho1 + u) ** 2 + v**2)
+    phi = (phi1 + np.arctan2(v, rho1 + u) + np.pi) % (2 * np.pi) - np.pi # back into -pi to pi
+    z = rho1 * np.sinh(eta1) + rho2 * np.sinh(eta2)
+    return rho, phi, np.arcsinh(z / rho), t1 + t2
+
+
+# invariant mass of the first 4 leptons from dense arrays, the same value as calc_mllll
+def dense_mllll(lep_pt, lep_eta, lep_phi, lep_E):
+    rho, phi, eta, t = lep_pt[:, 0], lep_phi[:, 0], lep_eta[:, 0], lep_E[:, 0]
+    for i in range(1, 4):
+        rho, phi, eta, t = add_rhophi_eta_t(rho, phi, eta, t, lep_pt[:, i], lep_phi[:, i], lep_eta[:, i], lep_E[:, i])
+    expmeta = np.exp(-eta)
+    invsintheta = 0.5 * (1 + expmeta**2) / expmeta
+    squared = t**2 - rho**2 * invsintheta**2
+    return np.copysign(np.sqrt(np.absolute(squared)), squared) * MeV
+
+
+# apply the cuts to a chunk and add totalWeight (MC only, when xsec_weight is given) and mllll,
+# converting the lepton branches to dense arrays once
+def dense_cut_weight_mass(data, xsec_weight=None):
+    offsets, _ = lepton_buffers(data.lep_pt)
+    index = first_four_index(offsets) # the same for every lepton branch
+    mask = dense_selection_mask(lepton_buffers(data.lep_charge)[1][index], lepton_buffers(data.lep_type)[1][index])
+    index = index[mask] # kinematics are only needed for events passing the cuts
+    dense = {name: lepton_buffers(data[name])[1][index] for name in ['lep_pt','lep_eta','lep_phi','lep_E']}
+
+    data = data[mask]
+    if xsec_weight is not None:
+        data['totalWeight'] = calc_weight(xsec_weight, data)
+    data['mllll'] = dense_mllll(dense['lep_pt'], dense['lep_eta'], dense['lep_phi'], dense['lep_E'])
+    return data
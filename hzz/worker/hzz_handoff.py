@@ -0,0 +1,117 @@
+import os
+import json
+import time # for polling when inotify is not available
+import select # to wait on inotify with a timeout
+import ctypes # inotify is called straight from libc, it has no module in the standard library
+import ctypes.util
+import contextlib # for atomic_open
+
+#===================================================================================
+# Handing files from one stage to the next through the shared data directory, the same file
+# is kept in counter, worker and collector
+#
+# Every file a later stage reads is written under a temporary name and renamed into place, so it
+# only appears once it is complete. When a worker has put all of its files in place it adds an entry
+# for its rank to data/finished, which is what the collector waits on. Stages wait for files with
+# inotify on Linux, so they start as soon as the rename happens, looking again every recheck seconds
+# in case a change was missed (e.g. made on another node of a network file system). Without inotify
+# the directory is polled every poll_interval seconds.
+
+# Directory holding an entry for each rank that has finished, and a level_<l> directory for each level of reducers
+finished_directory = 'data/finished'
+
+# Seconds between looks at a directory without inotify, and between looks with it in case an event was missed
+poll_interval = 0.05
+recheck = 1.0
+
+# inotify events meaning a file may have appeared in the directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+#===================================================================================
+# Writing
+
+# Define function to open a file to write that only appears at path once it is closed
+@contextlib.contextmanager
+def atomic_open(path, mode='wb'):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, mode) as tf:
+            yield tf
+        os.replace(temp_path, path) # rename is atomic, readers see the old file or the whole new one
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# Define function to record that a rank (or reducer) has finished and which files it saved
+def mark_finished(rank, entry, directory=finished_directory):
+    os.makedirs(directory, exist_ok=True)
+    with atomic_open(os.path.join(directory, f'rank_{rank}.json'), 'w') as ff:
+        json.dump(dict(entry, rank=rank), ff)
+
+# Define function to get the entries of the ranks (or reducers) that have finished, by rank
+def finished_ranks(directory=finished_directory):
+    finished = {}
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if name.startswith('rank_') and name.endswith('.json'):
+            with open(os.path.join(directory, name), 'r') as ff:
+                entry = json.load(ff)
+            finished[entry['rank']] = entry
+    return finished
+
+#===================================================================================
+# Reduction tree
+#
+# With a fan-in of k, reducer j of level 1 merges ranks j*k to j*k+k-1, reducer j of level 2 merges
+# reducers j*k to j*k+k-1 of level 1, and so on until a level has at most k reducers, which the collector merges
+
+# Define function to get the directory of the entries of a level of the reduction tree, level 0 being the ranks
+def level_directory(level):
+    return finished_directory if level == 0 else os.path.join(finished_directory, f'level_{level}')
+
+# Define function to get the number of outputs at each level of the reduction tree of n ranks, the last
+# being the level the collector merges (fan_in of 0 or 1 for no reducers)
+def level_sizes(n, fan_in):
+    sizes = [n]
+    while fan_in > 1 and sizes[-1] > fan_in:
+        sizes.append(-(-sizes[-1]//fan_in)) # rounded up
+    return sizes
+
+#===================================================================================
+# Waiting
+
+# Define function to start watching a directory with inotify, returns None if inotify is not available
+def watch(directory):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None # not Linux
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+# Define function to wait until condition() is true, waking up whenever a file changes in directory
+def wait_until(condition, directory):
+    os.makedirs(directory, exist_ok=True)
+    fd = watch(directory) # watching starts before the first look, so no change in between is missed
+    try:
+        while not condition():
+            if fd is None:
+                time.sleep(poll_interval)
+                continue
+            ready, _, _ = select.select([fd], [], [], recheck)
+            if ready:
+                try:
+                    while os.read(fd, 65536): # empty the events, only the condition matters
+                        pass
+                except BlockingIOError:
+                    pass
+    finally:
+        if fd is not None:
+            os.close(fd)
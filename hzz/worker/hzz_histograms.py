@@ -0,0 +1,126 @@
+import awkward as ak # to represent nested data in columnar format
+import numpy as np
+import pickle
+
+# pyarrow is only needed to read ranks saved with --output parquet
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+#===================================================================================
+# m4l histograms filled by the workers and added together by the reducers and collector,
+# the same file is kept in worker and collector
+
+# Set units
+MeV = 0.001
+GeV = 1.0
+
+# Binning of the m4l plot
+xmin = 80 * GeV
+xmax = 250 * GeV
+step_size = 5 * GeV
+
+bin_edges = np.arange(start=xmin, # The interval includes this value
+                      stop=xmax+step_size, # The interval doesn't include this value
+                      step=step_size ) # Spacing between values
+bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
+                        stop=xmax+step_size/2, # The interval doesn't include this value
+                        step=step_size ) # Spacing between values
+
+#===================================================================================
+# Histogram functions
+
+# Number of bins
+n_bins = len(bin_edges) - 1
+
+# Define function to make a histogram with nothing in it
+def empty_histogram():
+    return {'counts': np.zeros(n_bins, dtype=np.int64), # number of events in each bin
+            'sumw': np.zeros(n_bins), # sum of weights in each bin
+            'sumw2': np.zeros(n_bins)} # sum of squared weights in each bin, for the statistical uncertainty
+
+# Define function to get the bin of each mass inside the plot, worked out from the fixed bin width instead of searching
+# the bin edges, returns the bins and which masses are inside. Bins are the same as np.histogram's (the top edge is in the last bin)
+def bin_index(mllll):
+    mllll = np.asarray(mllll, dtype=np.float64)
+    inside = (mllll >= bin_edges[0]) & (mllll <= bin_edges[-1])
+    x = mllll[inside]
+    index = ((x - bin_edges[0])*(n_bins/(bin_edges[-1] - bin_edges[0]))).astype(np.intp)
+    index[index == n_bins] = n_bins - 1 # top edge
+    # rounding can put a mass right next to an edge in the neighbouring bin, correct against the edges as np.histogram does
+    index -= x < bin_edges[index]
+    index += (x >= bin_edges[index + 1]) & (index != n_bins - 1)
+    return index, inside
+
+# Define function to fill a histogram with masses, weighted by weights (1 for real data when weights is None),
+# finding the bins once and adding up counts, weights and squared weights with np.bincount
+def fill_histogram(histogram, mllll, weights=None):
+    index, inside = bin_index(mllll)
+    counts = np.bincount(index, minlength=n_bins)
+    histogram['counts'] += counts
+    if weights is None:
+        histogram['sumw'] += counts
+        histogram['sumw2'] += counts
+    else:
+        weights = np.asarray(weights, dtype=np.float64)[inside]
+        histogram['sumw'] += np.bincount(index, weights=weights, minlength=n_bins)
+        histogram['sumw2'] += np.bincount(index, weights=weights*weights, minlength=n_bins)
+    return histogram
+
+# Define function to add a histogram on to a running total
+def add_histograms(total, histogram):
+    for key in total:
+        total[key] += histogram[key]
+    return total
+
+#===================================================================================
+# Reading the files saved by ranks and reducers
+
+# Columns of the selected events the histograms are filled from, the columns workers save by default
+histogram_columns = ['mllll','totalWeight']
+
+# Columns of the Parquet files needed for the plot
+parquet_columns = ['sample'] + histogram_columns
+
+# Define function to read the events of a Parquet file into a dictionary of categories, like the pickles.
+# The file is memory mapped and only the columns of the plot are read
+def read_parquet(path, samples):
+    if pq is None:
+        raise ImportError(f'pyarrow is needed to read {path}')
+    schema = pq.read_schema(path)
+    table = pq.read_table(path, columns=[c for c in parquet_columns if c in schema.names], memory_map=True)
+    categories = {}
+    for s in samples:
+        events = table.filter(pc.is_in(table['sample'].cast(pa.string()), value_set=pa.array(samples[s]['list'])))
+        # leave out the sample and any column with no values in this category (totalWeight of real data)
+        events = events.select([c for c in events.column_names if c != 'sample' and (len(events) == 0 or events[c].null_count < len(events))])
+        categories[s] = ak.from_arrow(events) if events.num_columns > 0 else ak.Array([])
+    return categories
+
+# Define function to histogram the selected events of each category
+def histogram_events(data, samples):
+    histograms = {}
+    for s in samples:
+        histograms[s] = empty_histogram()
+        if s in data and len(data[s]) > 0:
+            weights = ak.to_numpy(data[s].totalWeight) if s != 'data' else None # real data is not weighted
+            fill_histogram(histograms[s], ak.to_numpy(data[s]['mllll']), weights)
+    return histograms
+
+# Define function to get the histogram of each category from a file saved by a rank or reducer: selected events
+# (data_{i}.pkl or data_{i}.parquet), which are histogrammed, or m4l histograms (hist_*.pkl)
+def saved_histograms(path, samples):
+    name = path.split('/')[-1]
+    if name.startswith('hist'):
+        with open(path, 'rb') as file:
+            saved = pickle.load(file)
+        if not np.array_equal(saved['bin_edges'], bin_edges):
+            raise ValueError(f'{name} was filled with different bins to the plot')
+        return saved['categories']
+    if name.endswith('.parquet'):
+        return histogram_events(read_parquet(path, samples), samples)
+    with open(path, 'rb') as file:
+        return histogram_events(pickle.load(file), samples)
@@ -0,0 +1,206 @@
+import uproot # for reading .root files
+import time # to measure download time
+import json # the mirror manifest is stored as a json file
+import os
+import argparse # for passing command line arguments
+import threading # to keep the manifest right with several downloads at once
+import urllib.request # for downloading ranges of the remote files
+from concurrent.futures import ThreadPoolExecutor, as_completed # for downloading several files at once
+
+import infofile # local file containing cross-sections, sums of weights, dataset IDs
+import hzz_cache # local file with the on-disk cache of byte ranges of remote files
+
+#===================================================================================
+# Local copy of the 4lep sample files, made with
+#     python counter/hzz_mirror.py
+# and used by the counter and worker in place of the web address for every file the mirror holds
+# whole. The same file is kept in counter and worker.
+#
+# Each file is downloaded to <name>.part and only renamed to <name> once its size matches the size
+# on the server, so an interrupted download is carried on from where it stopped by running the command
+# again. Finished files are recorded in manifest.json with their size and ETag.
+
+# Web address the files are mirrored from
+tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
+
+# Where the mirror is kept, inside data so it is shared with the containers, directory None turns it off
+settings = {'directory': 'data/mirror'}
+
+# Samples in the 4lep set
+sample_names = ['data_A','data_B','data_C','data_D',
+                'Zee','Zmumu','ttbar_lep',
+                'llll',
+                'ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep']
+
+# Bytes read from the server before writing to disk
+block_size = 1024*1024
+
+# Manifest of the mirror, loaded when first needed
+manifest_state = {'manifest': None}
+manifest_lock = threading.Lock()
+
+#===================================================================================
+# Mirror lookup
+
+# Define function to get the path of a sample file relative to tuple_path
+def relative_path(val):
+    if val.startswith('data_'): prefix = "Data/" # Data prefix
+    else: # MC prefix
+        prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
+    return prefix+val+".4lep.root"
+
+# Define function to get the path of the manifest of the mirror
+def manifest_path():
+    return os.path.join(settings['directory'], 'manifest.json')
+
+# Define function to load the manifest of the mirror, empty when there is no mirror
+def load_manifest():
+    if manifest_state['manifest'] is None:
+        manifest = {'url': None, 'files': {}}
+        if settings['directory'] is not None and os.path.exists(manifest_path()):
+            try:
+                with open(manifest_path(), 'r') as mf:
+                    manifest = json.load(mf)
+            except (ValueError, OSError):
+                print('Mirror manifest could not be read, reading files from the server')
+        manifest_state['manifest'] = manifest
+    return manifest_state['manifest']
+
+# Define function to save the manifest of the mirror
+def save_manifest(manifest):
+    hzz_cache.write_atomic(manifest_path(), json.dumps(manifest, indent=1).encode())
+
+# Define function to get the path of a file in the mirror
+def local_path(relative):
+    return os.path.join(settings['directory'], relative)
+
+# Define function to get where to read a file from, the mirror when it holds the whole file
+# mirrored from the same address, the address otherwise
+def resolve(url, relative):
+    manifest = load_manifest()
+    entry = manifest['files'].get(relative)
+    if manifest['url'] == url and entry is not None:
+        path = local_path(relative)
+        if os.path.exists(path) and os.path.getsize(path) == entry['size']:
+            return path
+    return url + relative
+
+# Define function to get the options for uproot.open, memory mapping local files and reading
+# remote ones through the byte range cache
+def open_options(path):
+    if '://' not in path:
+        return {'handler': uproot.source.file.MemmapSource}
+    return hzz_cache.open_options(path)
+
+#===================================================================================
+# Downloading
+
+# Define function to get the size and ETag of a file on the server
+def remote_file(url):
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return int(response.headers['Content-Length']), response.headers.get('ETag')
+
+# Define function to download a file, carrying on from the part already downloaded,
+# returns its manifest entry and the number of bytes downloaded
+def download(url, path):
+    size, etag = remote_file(url)
+    part_path = path + '.part'
+    have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if have > size:
+        have = 0 # file on the server has changed, start again
+
+    downloaded = 0
+    if have < size:
+        headers = {'Range': f'bytes={have}-'}
+        if etag is not None:
+            headers['If-Range'] = etag # whole file is sent instead if it has changed since the part was downloaded
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+            if response.status != 206:
+                have = 0 # server sent the whole file
+            with open(part_path, 'r+b' if have else 'wb') as pf:
+                pf.seek(have)
+                pf.truncate()
+                while True:
+                    block = response.read(block_size)
+                    if not block:
+                        break
+                    pf.write(block)
+                    downloaded += len(block)
+
+    if os.path.getsize(part_path) != size:
+        raise OSError(f'{path}: downloaded {os.path.getsize(part_path)} bytes of {size}') # part is kept to carry on from
+    os.replace(part_path, path)
+    return {'size': size, 'etag': etag}, downloaded
+
+# Define function to download a file into the mirror, trying again from where it stopped if it fails
+def mirror_file(url, relative, retries=3):
+    path = local_path(relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for attempt in range(retries + 1):
+        try:
+            entry, downloaded = download(url + relative, path)
+            break
+        except OSError as error:
+            if attempt == retries:
+                raise
+            print(f'\t{relative}: {error}, trying again')
+            time.sleep(2**attempt)
+
+    with manifest_lock:
+        manifest = load_manifest()
+        manifest['files'][relative] = entry
+        save_manifest(manifest) # saved after every file so a stopped run keeps the files it finished
+    return downloaded
+
+# Define function to mirror sample files, skipping ones already in the mirror
+def mirror(url, names, concurrency=4, retries=3):
+    manifest = load_manifest()
+    if manifest['url'] != url:
+        manifest['url'], manifest['files'] = url, {} # mirror of a different address, download again
+
+    relatives = [relative_path(val) for val in names]
+    missing = [relative for relative in relatives if resolve(url, relative) != local_path(relative)]
+    print(f'{len(relatives) - len(missing)} of {len(relatives)} files already mirrored in {settings["directory"]}')
+
+    start = time.time() # start the clock
+    total = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(mirror_file, url, relative, retries): relative for relative in missing}
+        for future in as_completed(futures):
+            relative = futures[future]
+            try:
+                downloaded = future.result()
+            except OSError as error:
+                failed.append(relative)
+                print(f'\tFailed: {relative}: {error}')
+                continue
+            total += downloaded
+            print(f'\tMirrored: {relative}, {round(downloaded/1e6,1)}MB downloaded')
+
+    elapsed = time.time() - start
+    print(f'Downloaded {round(total/1e6,1)}MB in {round(elapsed,1)}s')
+    if failed:
+        print(f'{len(failed)} files not mirrored, run again to carry on downloading them')
+    return failed
+
+#===================================================================================
+# Command line interface for making the mirror
+
+def main():
+    parser = argparse.ArgumentParser(description='Downloads the 4lep sample files so the counter and worker read them from local disk')
+    parser.add_argument('--url', default=tuple_path, help='Web address the files are mirrored from')
+    parser.add_argument('--mirror', default=settings['directory'], help='Directory the mirror is kept in')
+    parser.add_argument('--samples', nargs='+', default=sample_names, help='Samples to mirror, every sample of the 4lep set by default')
+    parser.add_argument('--concurrency', default=4, type=int, help='Number of files to download at once')
+    parser.add_argument('--retries', default=3, type=int, help='Times a failed download is carried on before giving up')
+    args = parser.parse_args()
+
+    settings['directory'] = args.mirror
+    failed = mirror(args.url, args.samples, args.concurrency, args.retries)
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import awkward as ak # to represent nested data in columnar format
+import numpy as np
+
+from hzz_cuts import lepton_buffers, first_four_index, dense_mllll # local file containing cuts and mass calculation
+
+# numba is optional, without it the worker keeps using the jagged awkward functions of hzz_cuts
+try:
+    import numba
+    available = True
+except ImportError:
+    available = False
+
+#===================================================================================
+# Compiled kernel doing the charge cut, type cut and total weight of a chunk in one pass over the
+# flat lepton buffers, used by hzz_script.read_file with --kernel numba
+#
+# The 4-lepton invariant mass of the events kept is then worked out by dense_mllll of hzz_cuts. Compiled
+# sin, cos, sinh, arcsinh and arctan2 differ from NumPy's by enough for the cancellation in the mass
+# to move events across a bin edge, so only the cuts and weights, which agree exactly, are compiled
+
+# Weight branches multiplied together, in the order calc_weight multiplies them
+weight_variables = ['mcWeight','scaleFactor_PILEUP','scaleFactor_ELE','scaleFactor_MUON','scaleFactor_LepTRIGGER']
+
+if available:
+    # Define function to cut and weight every event, returns the number of events passing
+    # and fills keep and total_weight (the last only for passing events)
+    @numba.njit(cache=True)
+    def fused_kernel(offsets, charge, lep_type, weights, xsec_weight, keep, total_weight):
+        n_pass = 0
+        for i in range(len(offsets) - 1):
+            first = offsets[i]
+            sum_lep_charge = charge[first] + charge[first+1] + charge[first+2] + charge[first+3]
+            sum_lep_type = lep_type[first] + lep_type[first+1] + lep_type[first+2] + lep_type[first+3]
+            keep[i] = sum_lep_charge == 0 and (sum_lep_type == 44 or sum_lep_type == 48 or sum_lep_type == 52)
+            if not keep[i]:
+                continue
+
+            weight = xsec_weight
+            for k in range(weights.shape[0]): # no weight branches for data
+                weight = weight*weights[k, i]
+            total_weight[n_pass] = weight
+            n_pass += 1
+        return n_pass
+
+# Define function to apply the cuts to a chunk and add totalWeight (MC only, when xsec_weight is given) and mllll,
+# giving the same chunk as the jagged functions of hzz_cuts
+def cut_weight_mass(data, xsec_weight=None):
+    offsets, charge = lepton_buffers(data.lep_charge)
+    n_events = len(offsets) - 1
+    if xsec_weight is None:
+        weights = np.empty((0, n_events), dtype=np.float32)
+    else:
+        weights = np.stack([ak.to_numpy(data[name]) for name in weight_variables])
+
+    keep = np.empty(n_events, dtype=np.bool_)
+    total_weight = np.empty(n_events, dtype=np.float32)
+    n_pass = fused_kernel(offsets, charge, lepton_buffers(data.lep_type)[1], weights,
+                          np.float32(0 if xsec_weight is None else xsec_weight), keep, total_weight)
+
+    index = first_four_index(offsets)[keep] # first 4 leptons of the events kept, the only ones the mass needs
+    dense = {name: lepton_buffers(data[name])[1][index] for name in ['lep_pt','lep_eta','lep_phi','lep_E']}
+
+    data = data[keep]
+    if xsec_weight is not None:
+        data['totalWeight'] = total_weight[:n_pass]
+    data['mllll'] = dense_mllll(dense['lep_pt'], dense['lep_eta'], dense['lep_phi'], dense['lep_E'])
+    return data
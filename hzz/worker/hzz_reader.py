@@ -0,0 +1,243 @@
+import awkward as ak # to represent nested data in columnar format
+import numpy as np
+import bisect # for finding which basket an entry is in
+import collections # for the queue of prefetched chunks
+import threading # for reading chunks in the background
+import time # to measure time spent reading and waiting
+import os # for the page size of the resident memory
+
+from hzz_cuts import selection_mask # local file containing cuts and mass calculation
+
+#===================================================================================
+# Ways of reading chunks of a tree, used by hzz_script.read_file
+
+# Branches the preselection is made on, read first in lazy mode
+preselection_variables = ['lep_charge','lep_type']
+
+#===================================================================================
+# Basket accounting
+
+# Define function to get the baskets of a branch holding entries start <= entry < stop
+def basket_range(branch, start, stop):
+    offsets = branch.entry_offsets
+    first = bisect.bisect_right(offsets, start) - 1
+    last = bisect.bisect_left(offsets, stop) - 1
+    return range(max(first, 0), min(last + 1, branch.num_baskets))
+
+# Define function to add the compressed and uncompressed bytes of baskets to a running total
+def add_basket_bytes(read_bytes, branch, baskets):
+    for k in baskets:
+        read_bytes['compressed'] += branch.basket_compressed_bytes(k)
+        read_bytes['uncompressed'] += branch.basket_uncompressed_bytes(k)
+
+# Define function to get bytes read by reading every branch for entries start <= entry < stop
+def eager_bytes(tree, variables, start, stop):
+    read_bytes = {'compressed': 0, 'uncompressed': 0}
+    for name in variables:
+        add_basket_bytes(read_bytes, tree[name], basket_range(tree[name], start, stop))
+    return read_bytes
+
+#===================================================================================
+# Chunk sizing for --memory_budget
+
+# Peak memory of a chunk is taken as this many times its uncompressed branch bytes until it has been measured
+default_expansion = 4
+
+# Fewest entries in a chunk, below this the time per chunk of uproot and awkward outweighs the memory saved
+min_step = 1000
+
+# Define function to get uncompressed bytes per entry of the branches read
+def uncompressed_bytes_per_entry(tree, variables):
+    return sum(tree[name].uncompressed_bytes for name in variables)/max(tree.num_entries, 1)
+
+# Define function to get the number of entries a chunk can have and stay within the budget
+def budget_step(sizing, bytes_per_entry):
+    return max(int(sizing['budget']/(sizing['expansion']*bytes_per_entry)), min_step)
+
+# Define function to give entry ranges of chunks, each sized with the latest expansion, which
+# is updated between chunks. Each chunk ends on the last of boundaries (entries where the baskets of
+# every branch read line up, from tree.common_entry_offsets) that fits in the budget, so baskets are
+# not fetched and decompressed again for the next chunk. Baskets bigger than the budget are cut into
+# equal chunks ending on their last entry, the only case where a basket is read for more than one chunk
+def budgeted_ranges(sizing, bytes_per_entry, entry_start, entry_stop, boundaries=()):
+    boundaries = list(boundaries)
+    start = entry_start
+    while start < entry_stop:
+        step = budget_step(sizing, bytes_per_entry)
+        stop = min(start + step, entry_stop)
+        k = bisect.bisect_right(boundaries, stop) - 1 # last boundary at or before stop
+        if stop < entry_stop and k >= 0 and boundaries[k] > start:
+            stop = int(boundaries[k])
+        elif stop < entry_stop and k + 1 < len(boundaries):
+            end = min(int(boundaries[k + 1]), entry_stop) # no boundary fits, cut up to the next one evenly
+            stop = start + -(-(end - start)//-(-(end - start)//step)) # rounded up
+        yield start, stop
+        start = stop
+
+# Define function to get the resident memory of this process in bytes
+def resident_bytes():
+    with open('/proc/self/statm', 'r') as statm:
+        return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+# Define function to start measuring the peak resident memory of a chunk, returns the resident memory to measure from.
+# The kernel's high-water mark of the process is reset (Linux only, raises OSError elsewhere), which unlike
+# tracemalloc costs nothing while the chunk is read and processed
+def reset_peak():
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    return resident_bytes()
+
+# Define function to get the peak resident memory in bytes since reset_peak
+def peak_bytes():
+    with open('/proc/self/status', 'r') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])*1024 # in kB
+    raise OSError('no VmHWM in /proc/self/status')
+
+# Define function to update the expansion with the measured peak memory of a chunk
+def update_expansion(sizing, peak, entries, bytes_per_entry):
+    measured = peak/(max(entries, 1)*bytes_per_entry)
+    if measured > sizing['expansion']:
+        # over what was expected, make chunks smaller straight away, at most halving them so
+        # one-off memory use (e.g. the first chunk of a run) does not shrink them to nothing
+        sizing['expansion'] = min(measured, 2*sizing['expansion'])
+    else:
+        sizing['expansion'] = 0.5*(sizing['expansion'] + measured) # under, let chunks grow gradually
+
+#===================================================================================
+# Reading chunks
+
+# Define function to read chunks of branches, over uproot's own steps or over the given entry ranges,
+# giving each chunk with its first and last+1 entry
+def iterate_ranges(tree, variables, entry_start, entry_stop, ranges=None):
+    if ranges is None:
+        for arrays, report in tree.iterate(variables, # variables to read
+                                           library="ak", # choose output type as awkward array
+                                           entry_start=entry_start, entry_stop=entry_stop, report=True):
+            yield arrays, report.tree_entry_start, report.tree_entry_stop
+    else:
+        for start, stop in ranges:
+            yield tree.arrays(variables, library="ak", entry_start=start, entry_stop=stop), start, stop
+
+#===================================================================================
+# Lazy reading
+
+# Define function to split sorted basket numbers into runs of consecutive baskets
+def basket_runs(baskets):
+    if len(baskets) == 0:
+        return []
+    breaks = np.nonzero(np.diff(baskets) != 1)[0] + 1
+    return np.split(baskets, breaks)
+
+# Define function to read chunks of events passing the charge and type cuts, reading the
+# other branches only from baskets that hold at least one passing event, giving each chunk
+# with the first and last+1 entry it was cut from. The last basket read of each other branch is
+# kept when it reaches into the next chunk, so no basket is read twice. The bytes of each basket
+# are added to read_bytes once, like eager_bytes counts them
+def iterate_preselected(tree, variables, entry_start, entry_stop, read_bytes, ranges=None):
+    others = [name for name in variables if name not in preselection_variables]
+    counted = set() # (branch, basket) already added to read_bytes
+    kept = {} # branch: (basket, values of every entry of the basket) of a basket reaching into the next chunk
+
+    def count(name, baskets):
+        new = [k for k in baskets if (name, k) not in counted]
+        counted.update((name, k) for k in new)
+        add_basket_bytes(read_bytes, tree[name], new)
+
+    for arrays, start, stop in iterate_ranges(tree, preselection_variables, entry_start, entry_stop, ranges):
+        for name in preselection_variables:
+            count(name, basket_range(tree[name], start, stop))
+
+        mask = ak.to_numpy(selection_mask(arrays.lep_charge, arrays.lep_type))
+        passing = np.nonzero(mask)[0] + start # entry numbers of the passing events
+        if len(passing) == 0:
+            continue # none pass, nothing else to read
+
+        fields = {name: arrays[name][mask] for name in preselection_variables}
+        for name in others:
+            branch = tree[name]
+            offsets = np.asarray(branch.entry_offsets)
+            baskets = np.unique(np.searchsorted(offsets, passing, side='right') - 1) # basket of each passing event
+            carried = kept.pop(name, None)
+            pieces = []
+            for run in basket_runs(baskets):
+                run_start, run_stop = offsets[run[0]], offsets[run[-1] + 1] # whole baskets, they are decompressed whole anyway
+                run_values, to_read = [], run
+                if carried is not None and carried[0] == run[0]:
+                    run_values.append(carried[1]) # read for the chunk before
+                    to_read = run[1:]
+                if len(to_read):
+                    count(name, to_read)
+                    run_values.append(branch.array(entry_start=offsets[to_read[0]], entry_stop=run_stop, library="ak"))
+                run_values = ak.concatenate(run_values) if len(run_values) > 1 else run_values[0]
+                in_run = passing[(passing >= run_start) & (passing < run_stop)]
+                pieces.append(run_values[in_run - run_start])
+                if run_stop > stop:
+                    kept[name] = (run[-1], run_values[offsets[run[-1]] - run_start:]) # last basket reaches into the next chunk
+            fields[name] = ak.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+
+        yield ak.zip({name: fields[name] for name in variables}, depth_limit=1), start, stop # same record as tree.iterate
+
+#===================================================================================
+# Prefetching
+
+# Define function to give each chunk with the time taken to read it
+def timed_reads(chunks):
+    iterator = iter(chunks)
+    while True:
+        read_start = time.perf_counter()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        yield chunk, time.perf_counter() - read_start
+
+# Define function to give chunks as they are read, adding the time spent reading each one to stats
+def timed(chunks, stats):
+    for chunk, read_time in timed_reads(chunks):
+        stats.append({'read': read_time, 'wait': read_time}) # nothing else to do while reading
+        yield chunk
+
+# Define function to read and decompress chunks on a background thread while the caller works on
+# earlier ones, holding at most max_bytes of chunks read ahead (always at least one). The time spent
+# reading each chunk and the time the caller waited for it are added to stats
+def prefetch(chunks, max_bytes, stats):
+    queue = collections.deque()
+    condition = threading.Condition()
+    state = {'bytes': 0, 'done': False, 'error': None}
+
+    def reader():
+        try:
+            for chunk, read_time in timed_reads(chunks):
+                nbytes = chunk[0].nbytes
+                with condition:
+                    while queue and state['bytes'] + nbytes > max_bytes:
+                        condition.wait() # queue is full, wait for the caller to take a chunk
+                    queue.append((chunk, nbytes, read_time))
+                    state['bytes'] += nbytes
+                    condition.notify_all()
+        except Exception as error:
+            state['error'] = error # raised again in the caller
+        finally:
+            with condition:
+                state['done'] = True
+                condition.notify_all()
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        wait_start = time.perf_counter()
+        with condition:
+            while not queue and not state['done']:
+                condition.wait() # next chunk has not been read yet
+            if not queue:
+                break
+            chunk, nbytes, read_time = queue.popleft()
+            state['bytes'] -= nbytes
+            condition.notify_all()
+        stats.append({'read': read_time, 'wait': time.perf_counter() - wait_start})
+        yield chunk
+
+    if state['error'] is not None:
+        raise state['error']
+
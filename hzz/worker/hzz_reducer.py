@@ -0,0 +1,103 @@
+import pickle
+import time # to measure time to reduce
+import argparse # for passing command line arguments
+import multiprocessing # to run every reducer of the tree locally as processes
+import os
+
+import hzz_histograms # local file with the m4l histograms shared with the collector
+import hzz_handoff # local file with atomic writes and waiting for files of other stages
+
+#===================================================================================
+# Reducer of the reduction tree, merging the m4l histograms of fan_in ranks (or reducers of the level
+# below) as each finishes and saving their sum for the next level up, so with hundreds of ranks the collector
+# only merges the top level. Ranks that saved events are histogrammed here, so only histograms go up the tree.
+#
+# Run on the worker nodes with --level and --index, or with neither to run every reducer of the tree
+# locally as processes. The collector must be given the same --fan_in.
+
+parser = argparse.ArgumentParser(description='Merges the results of a group of ranks, or of reducers of the level below')
+parser.add_argument('--fan_in', default=4, type=int, help='Number of ranks, or reducers of the level below, each reducer merges')
+parser.add_argument('--level', default=None, type=int, help='Level of the tree of this reducer, 1 merging ranks')
+parser.add_argument('--index', default=None, type=int, help='Which reducer of its level this is')
+args = parser.parse_args()
+
+# Samples to process
+samples = {'data': {'list' : ['data_A','data_B','data_C','data_D'],
+                    },
+           r'Background $Z,t\bar{t}$' : { # Z + ttbar
+                                         'list' : ['Zee','Zmumu','ttbar_lep'],
+                                         'color' : "#6b59d3" # purple
+                                         },
+           r'Background $ZZ^*$' : { # ZZ
+                                   'list' : ['llll'],
+                                   'color' : "#ff0000" # red
+                                   },
+           r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
+                                          'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
+                                          'color' : "#00cdff" # light blue
+                                          },
+
+        }
+
+#===================================================================================
+# Waits to start until start and end dictionaries been produced, to find the number of ranks
+
+# Check starts and ends exist
+def check_start_file():
+    return os.path.exists('data/starts.pkl') and os.path.exists('data/ends.pkl')
+
+hzz_handoff.wait_until(check_start_file, 'data')
+
+with open('data/starts.pkl', 'rb') as sd:
+    n = len(pickle.load(sd))
+
+# Number of outputs at each level of the tree
+sizes = hzz_handoff.level_sizes(n, args.fan_in)
+
+#===================================================================================
+# Reducing
+
+# Define function to merge the children of a reducer as they finish and save their sum
+def reduce(level, index):
+    start = time.time() # start the clock
+    directory = hzz_handoff.level_directory(level - 1) # entries of the children
+    children = range(index*args.fan_in, min((index + 1)*args.fan_in, sizes[level - 1]))
+    results = {} # histograms of each child, by child
+
+    while len(results) < len(children):
+        hzz_handoff.wait_until(lambda: any(i in children and i not in results for i in hzz_handoff.finished_ranks(directory)),
+                               directory)
+        for i, entry in sorted(hzz_handoff.finished_ranks(directory).items()):
+            if i in children and i not in results:
+                results[i] = hzz_histograms.saved_histograms(f"data/{entry['output']}", samples)
+
+    # add up in order of child, so the sums do not depend on the order they finished in
+    categories = {s: hzz_histograms.empty_histogram() for s in samples}
+    for i in sorted(results):
+        for s, histogram in results[i].items():
+            hzz_histograms.add_histograms(categories[s], histogram)
+
+    output = f'hist_level{level}_{index}.pkl'
+    with hzz_handoff.atomic_open(f'data/{output}') as h:
+        pickle.dump({'bin_edges': hzz_histograms.bin_edges, 'categories': categories}, h)
+    hzz_handoff.mark_finished(index, {'output': output, 'children': list(children)}, hzz_handoff.level_directory(level))
+    print(f'level {level} reducer {index}: merged {len(children)} outputs of level {level-1} in {round(time.time()-start,2)}s')
+
+def main():
+    if len(sizes) == 1:
+        print(f'{n} ranks with a fan-in of {args.fan_in}, the collector merges the ranks itself')
+        return
+    if args.level is not None:
+        reduce(args.level, args.index)
+        return
+
+    # every reducer of the tree, each waits for its own children
+    print(f'Reducing {n} ranks with a fan-in of {args.fan_in}: '+', '.join(f'{size} reducers at level {level}' for level, size in enumerate(sizes) if level > 0))
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=reduce, args=(level, index)) for level in range(1, len(sizes)) for index in range(sizes[level])]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+main()
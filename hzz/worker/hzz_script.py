@@ -1,254 +1,514 @@
-import uproot # for reading .root files
-import awkward as ak # to represent nested data in columnar format
-import vector # for 4-momentum calculations
-import time # to measure time to analyse
-import math # for mathematical functions such as square root
-import argparse # for passing command line arguments
-import pickle
-import os
-
-import infofile # local file containing cross-sections, sums of weights, dataset IDs
-
-#===================================================================================
-# Command line arguments
-
-parser = argparse.ArgumentParser(description='Runs the HZZ analysis on data')
-parser.add_argument('--rank', default = 0, help = 'which division node is doing' )
-
-args = parser.parse_args()
-
-#===================================================================================
-# Waits to start until start and end dictionaries been produced
-
-# Function to check for the presence of files
-def check_files():
-    return os.path.exists('data/starts.pkl') and os.path.exists('data/ends.pkl')
-
-# Wait until both files are present
-while not check_files():
-    time.sleep(1)
-#===================================================================================
-# Load in start and end points
-
-with open('data/starts.pkl', 'rb') as sd:
-    start_dicts = pickle.load(sd)
-
-with open('data/ends.pkl', 'rb') as ed:
-    end_dicts = pickle.load(ed)
-
-rank = int(args.rank)
-
-# Do validation checks
-if len(start_dicts) != len(end_dicts):
-    raise IndexError('Start and End dictionaries are not the same length')
-
-if rank >= len(start_dicts):
-    raise ImportError(f'Highest rank possible is {len(start_dicts)-1}')
-
-start_dict = start_dicts[rank]
-end_dict = end_dicts[rank]
-
-#print('========================================')
-#print('starts:')
-#for i, output_dict in enumerate(start_dicts):
-    #print(f"Dictionary {i+1}: {output_dict}\n")
-#print('=====')
-#print('ends:')
-#for i, output_dict in enumerate(end_dicts):
-    #print(f"Dictionary {i+1}: {output_dict}\n")
-#print('========================================')
-#===================================================================================
-# Define variables
-
-#General definitions of fraction of data used, where to access the input files
-
-#lumi = 0.5 # fb-1 # data_A only
-#lumi = 1.9 # fb-1 # data_B only
-#lumi = 2.9 # fb-1 # data_C only
-#lumi = 4.7 # fb-1 # data_D only
-lumi = 10 # fb-1 # data_A,data_B,data_C,data_D
-                                                                                                                                  
-#tuple_path = "Input/4lep/" # local 
-tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
-
-
-# Samples to process
-samples = {'data': {'list' : ['data_A','data_B','data_C','data_D'],
-                    },
-           r'Background $Z,t\bar{t}$' : { # Z + ttbar
-                                         'list' : ['Zee','Zmumu','ttbar_lep'],
-                                         'color' : "#6b59d3" # purple
-                                         },
-           r'Background $ZZ^*$' : { # ZZ
-                                   'list' : ['llll'],
-                                   'color' : "#ff0000" # red
-                                   },
-           r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
-                                          'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
-                                          'color' : "#00cdff" # light blue
-                                          },
-
-        }
-
-# Set units
-MeV = 0.001
-GeV = 1.0
-
-#===================================================================================
-# Weight functions 
-
-# Define function to calculate weight of MC event
-def calc_weight(xsec_weight, events):
-    return (xsec_weight * events.mcWeight * events.scaleFactor_PILEUP * events.scaleFactor_ELE * events.scaleFactor_MUON * events.scaleFactor_LepTRIGGER)
-
-
-# Define function to get cross-section weight
-def get_xsec_weight(sample):
-    info = infofile.infos[sample] # open infofile
-    xsec_weight = (lumi*1000*info["xsec"])/(info["sumw"]*info["red_eff"]) #*1000 to go from fb-1 to pb-1
-    return xsec_weight # return cross-section weight
-
-
-def calc_mllll(lep_pt, lep_eta, lep_phi, lep_E):
-    # construct awkward 4-vector array
-    p4 = vector.zip({"pt": lep_pt, "eta": lep_eta, "phi": lep_phi, "E": lep_E})
-    # calculate invariant mass of first 4 leptons
-    # [:, i] selects the i-th lepton in each event
-    # .M calculates the invariant mass
-    return (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M * MeV
-
-#===================================================================================
-# Cut functions
-
-# cut on lepton charge
-# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
-def cut_lep_charge(lep_charge):
-# throw away when sum of lepton charges is not equal to 0
-# first lepton in each event is [:, 0], 2nd lepton is [:, 1] etc
-    return lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
-
-
-# cut on lepton type
-# paper: "selecting two pairs of isolated leptons, each of which is comprised of two leptons with the same flavour and opposite charge"
-def cut_lep_type(lep_type):
-# for an electron lep_type is 11
-# for a muon lep_type is 13
-# throw away when none of eeee, mumumumu, eemumu
-    sum_lep_type = lep_type[:, 0] + lep_type[:, 1] + lep_type[:, 2] + lep_type[:, 3]
-    return (sum_lep_type != 44) & (sum_lep_type != 48) & (sum_lep_type != 52)
-
-#===================================================================================
-# Data reading functions
-
-# Define function to read and process individual files
-def read_file(path,sample,s):
-    start = time.time() # start the clock
-    start_point = start_dict[s][sample]
-    end_point = end_dict[s][sample] + 1 # +1 as is the first point it ignores
-    print("\tProcessing: "+sample,f' - start point: {start_point} , end point: {end_point-1}') # print which sample is being processed
-    data_all = [] # define empty list to hold all data for this sample
-    nIn = end_point-start_point 
-    
-    # open the tree called mini using a context manager (will automatically close files/resources)
-    counter=0
-    with uproot.open(path + ":mini") as tree:
-        numevents = tree.num_entries # number of events
-        nOut = [0]*numevents
-        i = 0
-        
-        if 'data' not in sample:
-            xsec_weight = get_xsec_weight(sample) # get cross-section weight
-        for data in tree.iterate(['lep_pt','lep_eta','lep_phi',
-                                  'lep_E','lep_charge','lep_type', 
-                                  # add more variables here if you make cuts on them 
-                                  'mcWeight','scaleFactor_PILEUP',
-                                  'scaleFactor_ELE','scaleFactor_MUON',
-                                  'scaleFactor_LepTRIGGER'], # variables to calculate Monte Carlo weight
-                                 library="ak", # choose output type as awkward array
-                                 entry_start = start_point, # start entry at
-                                 entry_stop= end_point): # process up to numevents*fraction
-
-            if 'data' not in sample: # only do this for Monte Carlo simulation files
-                # multiply all Monte Carlo weights and scale factors together to give total weight
-                data['totalWeight'] = calc_weight(xsec_weight, data)
-
-            #if s == 'Signal ($m_H$ = 125 GeV)':
-             #   if counter%100 ==0:
-              #      print(counter) 
-               # counter +=1
-
-
-            # cut on lepton charge using the function cut_lep_charge defined above
-            data = data[~cut_lep_charge(data.lep_charge)]
-
-            # cut on lepton type using the function cut_lep_type defined above
-            data = data[~cut_lep_type(data.lep_type)]
-
-            # calculation of 4-lepton invariant mass using the function calc_mllll defined above
-            data['mllll'] = calc_mllll(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
-            
-            # array contents can be printed at any stage like this
-            #print(data)
-
-            # array column can be printed at any stage like this
-            #print(data['lep_pt'])
-
-            # multiple array columns can be printed at any stage like this
-            #print(data[['lep_pt','lep_eta']])
-
-            #nOut = len(data) # number of events passing cuts in this batch       
-            data_all.append(data) # append array from this batch
-
-            nOut[i] = len(data)
-            i+=1
-            
-        elapsed = time.time() - start # time taken to process
-        print("\t\t nIn: "+str(nIn)+'/'+str(numevents)+",\t nOut: \t"+str(sum(nOut))+"\t in "+str(round(elapsed,1))+"s") # events before and after
-    
-    return ak.concatenate(data_all) # return array containing events passing all cuts
-
-
-# Define function to get data from files
-def get_data_from_files():
-
-    data = {} # define empty dictionary to hold awkward arrays
-    for s in samples: # loop over samples
-        print('Processing '+s+' samples') # print which sample
-        frames = [] # define empty list to hold data
-        for val in samples[s]['list']: # loop over each file
-            if s == 'data': prefix = "Data/" # Data prefix
-            else: # MC prefix
-                prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
-            fileString = tuple_path+prefix+val+".4lep.root" # file name to open
-            temp = read_file(fileString,val,s) # call the function read_file defined below
-            frames.append(temp) # append array returned from read_file to list of awkward arrays
-        data[s] = ak.concatenate(frames) # dictionary entry is concatenated awkward arrays
-    
-    return data # return dictionary of awkward arrays
-
-#===================================================================================
-
-def main():
-    print('=======================')
-    print(f'Processing node {rank}')
-    print('=======================')
-
-    start = time.time() # time at start of whole processing
-    data = get_data_from_files() # process all files
-    elapsed = time.time() - start # time after whole processing
-    print("Time taken: "+str(round(elapsed,1))+"s") # print total time taken to process every file
-
-    with open(f'./data/data_{rank}.pkl', 'wb') as d:
-        pickle.dump(data, d)
-        print(f'data from {rank} saved')
-
-main()
-
-
-
-
-
-
-
-
-
+import uproot # for reading .root files
+import awkward as ak # to represent nested data in columnar format
+import numpy as np # for reading the manifest of start and end points
+import time # to measure time to analyse
+import math # for mathematical functions such as square root
+import argparse # for passing command line arguments
+import pickle
+import json
+import os
+import multiprocessing # for a pool of processes within the worker
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED # for processing several files at once
+
+import infofile # local file containing cross-sections, sums of weights, dataset IDs
+from hzz_cuts import calc_mllll, calc_weight, selection_mask, dense_cut_weight_mass # local file containing cuts and mass calculation
+import hzz_reader # local file with ways of reading chunks of a tree
+import hzz_numba # local file with the compiled cut and weight kernel
+import hzz_histograms # local file with the m4l histograms shared with the collector
+import hzz_cache # local file with the on-disk cache of byte ranges of remote files
+import hzz_mirror # local file with the local copy of the sample files
+import hzz_writer # local file writing the selected events to Parquet as they are processed
+import hzz_handoff # local file with atomic writes and waiting for files of other stages
+
+#===================================================================================
+# Command line arguments
+
+parser = argparse.ArgumentParser(description='Runs the HZZ analysis on data')
+parser.add_argument('--rank', default = 0, help = 'which division node is doing' )
+parser.add_argument('--read_mode', default='eager', choices=['eager','lazy'], help='eager reads every branch, lazy reads lepton charge and type first and the other branches only where events pass')
+parser.add_argument('--kernel', default='jagged', choices=['jagged','dense','numba'], help='jagged uses the awkward functions of hzz_cuts, dense converts the first 4 leptons to (events x 4) NumPy arrays, numba does cuts, weight and mass in one compiled pass')
+parser.add_argument('--output', default='events', choices=['events','histograms','parquet'], help='events saves the selected events, histograms saves only the m4l histograms of each file and category, parquet writes the selected events to a Parquet file chunk by chunk')
+parser.add_argument('--memory_budget', default=None, type=float, help='MB of memory each chunk may use, chunk sizes are worked out from the uncompressed bytes per entry and adjusted to the measured peak of each chunk')
+parser.add_argument('--prefetch', default=None, type=float, help='MB of chunks read ahead on a background thread while earlier chunks are processed (0 reads and processes in turn), the time spent waiting on reading and computing is printed for each chunk')
+parser.add_argument('--pool_size', default=1, type=int, help='Number of (sample, range) units processed at once (1 processes them one at a time)')
+parser.add_argument('--pool', default='thread', choices=['thread','process'], help='Process units at once on a pool of threads or of processes')
+parser.add_argument('--columns', nargs='+', default=hzz_histograms.histogram_columns, help="Columns saved for the collector, by default the ones its histograms are filled from, 'all' keeps every branch read")
+parser.add_argument('--compare_kernel', action='store_true', help='Also run the jagged kernel on every chunk and print the speedup of the chosen kernel')
+parser.add_argument('--byte_cache', default='data/byte_cache', help='Directory of the on-disk cache of byte ranges read from remote files, shared with the counter and other workers')
+parser.add_argument('--byte_cache_size', default=2000, type=float, help='MB the byte range cache may hold before the least recently used ranges are deleted')
+parser.add_argument('--no_byte_cache', action='store_true', help='Read remote files without the byte range cache')
+parser.add_argument('--mirror', default='data/mirror', help='Directory of the local copy of the sample files made by hzz_mirror.py, files it holds are read from local disk')
+parser.add_argument('--no_mirror', action='store_true', help='Read every file from the web address even if it is mirrored')
+
+args = parser.parse_args()
+
+# Byte ranges read from remote files are kept on disk, so repeat runs read them locally
+if not args.no_byte_cache:
+    hzz_cache.settings['directory'] = args.byte_cache
+    hzz_cache.settings['max_bytes'] = args.byte_cache_size*1e6
+
+# Files in the local mirror are read from disk instead of the web address
+hzz_mirror.settings['directory'] = None if args.no_mirror else args.mirror
+
+if args.kernel == 'numba' and not hzz_numba.available:
+    print('numba is not installed, using the jagged kernel')
+    args.kernel = 'jagged'
+
+if args.output == 'parquet' and not hzz_writer.available:
+    print('pyarrow is not installed, saving events to a pickle')
+    args.output = 'events'
+
+#===================================================================================
+# Waits to start until start and end dictionaries been produced
+
+# Function to check for the presence of files
+def check_files():
+    return os.path.exists('data/starts.pkl') and os.path.exists('data/ends.pkl')
+
+# Wait until both files are present, the counter renames each into place once it is complete
+hzz_handoff.wait_until(check_files, 'data')
+#===================================================================================
+# Load in start and end points
+
+rank = int(args.rank)
+
+# Manifest of (files x ranks) start and end matrices, written by the counter before the dictionaries
+manifest_path = 'data/manifest.npz'
+
+if os.path.exists(manifest_path):
+    # Only the column of this rank is needed
+    with np.load(manifest_path) as manifest:
+        if rank >= manifest['starts'].shape[1]:
+            raise ImportError(f'Highest rank possible is {manifest["starts"].shape[1]-1}')
+        start_dict, end_dict = {}, {}
+        for category, key, start_point, end_point in zip(manifest['categories'].tolist(), manifest['samples'].tolist(),
+                                                        manifest['starts'][:, rank].tolist(), manifest['ends'][:, rank].tolist()):
+            start_dict.setdefault(category, {})[key] = start_point
+            end_dict.setdefault(category, {})[key] = end_point
+
+else:
+    with open('data/starts.pkl', 'rb') as sd:
+        start_dicts = pickle.load(sd)
+
+    with open('data/ends.pkl', 'rb') as ed:
+        end_dicts = pickle.load(ed)
+
+    # Do validation checks
+    if len(start_dicts) != len(end_dicts):
+        raise IndexError('Start and End dictionaries are not the same length')
+
+    if rank >= len(start_dicts):
+        raise ImportError(f'Highest rank possible is {len(start_dicts)-1}')
+
+    start_dict = start_dicts[rank]
+    end_dict = end_dicts[rank]
+
+# Work queue written by the counter when tasks are handed out while running rather than up front
+queue_path = 'data/queue'
+dynamic = os.path.isdir(os.path.join(queue_path, 'todo'))
+
+#print('========================================')
+#print('starts:')
+#for i, output_dict in enumerate(start_dicts):
+    #print(f"Dictionary {i+1}: {output_dict}\n")
+#print('=====')
+#print('ends:')
+#for i, output_dict in enumerate(end_dicts):
+    #print(f"Dictionary {i+1}: {output_dict}\n")
+#print('========================================')
+#===================================================================================
+# Define variables
+
+#General definitions of fraction of data used, where to access the input files
+
+#lumi = 0.5 # fb-1 # data_A only
+#lumi = 1.9 # fb-1 # data_B only
+#lumi = 2.9 # fb-1 # data_C only
+#lumi = 4.7 # fb-1 # data_D only
+lumi = 10 # fb-1 # data_A,data_B,data_C,data_D
+                                                                                                                                  
+#tuple_path = "Input/4lep/" # local 
+tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/" # web address
+
+
+# Samples to process
+samples = {'data': {'list' : ['data_A','data_B','data_C','data_D'],
+                    },
+           r'Background $Z,t\bar{t}$' : { # Z + ttbar
+                                         'list' : ['Zee','Zmumu','ttbar_lep'],
+                                         'color' : "#6b59d3" # purple
+                                         },
+           r'Background $ZZ^*$' : { # ZZ
+                                   'list' : ['llll'],
+                                   'color' : "#ff0000" # red
+                                   },
+           r'Signal ($m_H$ = 125 GeV)' : { # H -> ZZ -> llll
+                                          'list' : ['ggH125_ZZ4lep','VBFH125_ZZ4lep','WH125_ZZ4lep','ZH125_ZZ4lep'],
+                                          'color' : "#00cdff" # light blue
+                                          },
+
+        }
+
+# Time taken, entries and compressed bytes read for each file, saved for the cost model
+timings = {}
+
+# m4l histogram of each file, filled with --output histograms
+histograms = {}
+
+# Parquet file of this rank with --output parquet. Chunks are written as they are processed, except
+# with a pool of processes, which hand back the events of each unit to be written by this process
+rank_writer = hzz_writer.RankWriter(f'./data/data_{rank}.parquet') if args.output == 'parquet' else None
+streaming = rank_writer is not None and not (args.pool == 'process' and args.pool_size > 1)
+
+# Memory budget of a chunk and how many times its uncompressed bytes a chunk takes up at its peak,
+# carried from file to file as it is measured
+chunk_sizing = {'budget': None if args.memory_budget is None else args.memory_budget*1e6,
+                'expansion': hzz_reader.default_expansion}
+# The peak of a chunk is the peak resident memory of the process, so with a pool of threads one unit's chunk cannot be
+# told apart from another's. Chunks are then sized from the default expansion without measuring, a pool of processes
+# measures in each process
+measure_chunks = args.memory_budget is not None and not (args.pool == 'thread' and args.pool_size > 1)
+if measure_chunks:
+    try:
+        hzz_reader.reset_peak()
+    except OSError:
+        measure_chunks = False
+        print('--memory_budget: the peak resident memory can not be reset here (Linux only), chunks are sized from the uncompressed bytes per entry and not adjusted to measured peaks')
+elif args.memory_budget is not None:
+    print(f'--memory_budget with a pool of {args.pool_size} threads: chunks are sized from the uncompressed bytes per entry and not adjusted to measured peaks')
+
+# Variables to read from each file
+variables = ['lep_pt','lep_eta','lep_phi',
+             'lep_E','lep_charge','lep_type', 
+             # add more variables here if you make cuts on them 
+             'mcWeight','scaleFactor_PILEUP',
+             'scaleFactor_ELE','scaleFactor_MUON',
+             'scaleFactor_LepTRIGGER'] # variables to calculate Monte Carlo weight
+
+#===================================================================================
+# Weight functions 
+
+# Define function to get cross-section weight
+def get_xsec_weight(sample):
+    info = infofile.infos[sample] # open infofile
+    xsec_weight = (lumi*1000*info["xsec"])/(info["sumw"]*info["red_eff"]) #*1000 to go from fb-1 to pb-1
+    return xsec_weight # return cross-section weight
+
+
+#===================================================================================
+# Data reading functions
+
+# Define function to apply the cuts to a chunk and add total weight (MC only) and mass using a kernel
+def process_chunk(data, sample, xsec_weight, kernel):
+    if kernel == 'numba':
+        # cuts and total weight in one compiled pass, mass on (events x 4) arrays of the events kept
+        return hzz_numba.cut_weight_mass(data, xsec_weight)
+    if kernel == 'dense':
+        # cuts and mass on (events x 4) arrays of the first 4 leptons
+        return dense_cut_weight_mass(data, xsec_weight)
+
+    if args.read_mode != 'lazy': # lazy chunks have already been cut
+        # cut on lepton charge and type together using the function selection_mask from hzz_cuts,
+        # so the chunk is only filtered once
+        data = data[selection_mask(data.lep_charge, data.lep_type)]
+
+    if 'data' not in sample: # only do this for Monte Carlo simulation files
+        # multiply all Monte Carlo weights and scale factors together to give total weight
+        data['totalWeight'] = calc_weight(xsec_weight, data)
+
+    # calculation of 4-lepton invariant mass using the function calc_mllll defined above
+    data['mllll'] = calc_mllll(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+    return data
+
+
+# Define function to read and process entries start_point <= entry < end_point of a file,
+# returns the events passing, the timing and, with --output histograms, the m4l histogram
+def read_file(path,sample,start_point,end_point):
+    start = time.time() # start the clock
+    print("\tProcessing: "+sample,f' - start point: {start_point} , end point: {end_point-1}') # print which sample is being processed
+    data_all = [] # define empty list to hold all data for this sample
+    nIn = end_point-start_point 
+
+    if nIn <= 0: # nothing to process from this file, so don't open it
+        print("\t\t nIn: 0,\t skipped")
+        return ak.Array([]), None, None # empty array, concatenates with arrays of any type
+    
+    # open the tree called mini using a context manager (will automatically close files/resources)
+    counter=0
+    with uproot.open(path + ":mini", **hzz_mirror.open_options(path)) as tree:
+        numevents = tree.num_entries # number of events
+        nOut = [0]*numevents
+        i = 0
+        
+        histogram = hzz_histograms.empty_histogram() if args.output == 'histograms' else None
+        xsec_weight = None # no weight for real data
+        if 'data' not in sample:
+            xsec_weight = get_xsec_weight(sample) # get cross-section weight
+        ranges = None # uproot's default step size
+        if args.memory_budget is not None:
+            # chunk sizes from the uncompressed bytes per entry, changed as peak memory is measured
+            bytes_per_entry = hzz_reader.uncompressed_bytes_per_entry(tree, variables)
+            ranges = hzz_reader.budgeted_ranges(chunk_sizing, bytes_per_entry, start_point, end_point,
+                                                tree.common_entry_offsets(filter_name=variables)) # chunks end where baskets do
+            chunk_peaks, chunk_sizes = [], []
+            if measure_chunks:
+                resident_before = hzz_reader.reset_peak()
+
+        if args.read_mode == 'lazy':
+            # chunks only hold events passing the charge and type cuts
+            read_bytes = {'compressed': 0, 'uncompressed': 0}
+            chunks = hzz_reader.iterate_preselected(tree, variables, start_point, end_point, read_bytes, ranges)
+        else:
+            chunks = hzz_reader.iterate_ranges(tree, variables, # variables to read
+                                               start_point, # start entry at
+                                               end_point, # process up to numevents*fraction
+                                               ranges)
+
+        if args.prefetch is not None:
+            io_stats = [] # time spent reading and waiting for each chunk
+            if args.prefetch > 0:
+                # read the next chunks while this one is processed
+                chunks = hzz_reader.prefetch(chunks, args.prefetch*1e6, io_stats)
+            else:
+                chunks = hzz_reader.timed(chunks, io_stats)
+            compute_times = []
+
+        for data, chunk_start, chunk_stop in chunks:
+            compute_start = time.perf_counter()
+
+            #if s == 'Signal ($m_H$ = 125 GeV)':
+             #   if counter%100 ==0:
+              #      print(counter) 
+               # counter +=1
+
+
+            chunk = data # keep the chunk as read for the comparison
+            kernel_start = time.perf_counter()
+            data = process_chunk(data, sample, xsec_weight, args.kernel)
+            kernel_time = time.perf_counter() - kernel_start
+
+            if args.compare_kernel and args.kernel != 'jagged':
+                jagged_start = time.perf_counter()
+                jagged_data = process_chunk(chunk, sample, xsec_weight, 'jagged')
+                jagged_time = time.perf_counter() - jagged_start
+                if len(jagged_data) != len(data):
+                    raise ValueError(f'{args.kernel} kernel keeps {len(data)} events, jagged kernel keeps {len(jagged_data)}')
+                for column in ['totalWeight','mllll'] if xsec_weight is not None else ['mllll']:
+                    if not np.array_equal(ak.to_numpy(data[column]), ak.to_numpy(jagged_data[column])):
+                        raise ValueError(f'{args.kernel} kernel gives a different {column} to the jagged kernel')
+                print(f"\t\t chunk {i}: {args.kernel} {round(kernel_time*1000,2)}ms, jagged {round(jagged_time*1000,2)}ms,"
+                      f" {round(jagged_time/max(kernel_time,1e-9),2)}x faster")
+
+            # array contents can be printed at any stage like this
+            #print(data)
+
+            # array column can be printed at any stage like this
+            #print(data['lep_pt'])
+
+            # multiple array columns can be printed at any stage like this
+            #print(data[['lep_pt','lep_eta']])
+
+            nOut[i] = len(data)
+            i+=1
+
+            if args.memory_budget is not None:
+                chunk_sizes.append(chunk_stop - chunk_start)
+            if measure_chunks:
+                # peak memory of reading and processing this chunk, to size the next one
+                peak = hzz_reader.peak_bytes() - resident_before
+                hzz_reader.update_expansion(chunk_sizing, peak, chunk_stop - chunk_start, bytes_per_entry)
+                chunk_peaks.append(peak)
+                resident_before = hzz_reader.reset_peak()
+
+            #nOut = len(data) # number of events passing cuts in this batch       
+            if args.prefetch is not None:
+                compute_times.append(time.perf_counter() - compute_start)
+                print(f"\t\t chunk {i-1}: read {round(io_stats[-1]['read']*1000,1)}ms, waited {round(io_stats[-1]['wait']*1000,1)}ms,"
+                      f" computed {round(compute_times[-1]*1000,1)}ms")
+
+            if args.output == 'histograms':
+                # fill the histogram of this file and let the events go
+                hzz_histograms.fill_histogram(histogram, data.mllll, data.totalWeight if xsec_weight is not None else None)
+                continue
+
+            if 'all' not in args.columns:
+                # keep only the columns the collector uses, packed so the rest of the chunk can be freed
+                data = ak.to_packed(data[[c for c in args.columns if c in data.fields]])
+            if streaming:
+                rank_writer.write(sample, data) # write the chunk and let it go
+                continue
+            data_all.append(data) # append array from this batch
+            
+        elapsed = time.time() - start # time taken to process
+        print("\t\t nIn: "+str(nIn)+'/'+str(numevents)+",\t nOut: \t"+str(sum(nOut))+"\t in "+str(round(elapsed,1))+"s") # events before and after
+
+        if args.memory_budget is not None and chunk_sizes:
+            peak = ", peak "+str(round(max(chunk_peaks)/1e6,2))+"MB" if chunk_peaks else "" # not measured with a pool of threads
+            print("\t\t "+str(len(chunk_sizes))+" chunks of "+str(min(chunk_sizes))+"-"+str(max(chunk_sizes))+" entries"
+                  +peak+" (budget "+str(round(chunk_sizing['budget']/1e6,2))+"MB)")
+
+        if args.prefetch is not None and compute_times:
+            read_time, wait_time = sum(s['read'] for s in io_stats), sum(s['wait'] for s in io_stats)
+            print("\t\t read "+str(round(read_time,2))+"s, waited "+str(round(wait_time,2))+"s, computed "+str(round(sum(compute_times),2))+"s,"
+                  +" "+str(round(read_time-wait_time,2))+"s of reading hidden behind computing")
+
+        if args.read_mode == 'lazy':
+            # bytes read against reading every branch of every entry
+            all_bytes = hzz_reader.eager_bytes(tree, variables, start_point, end_point)
+            print("\t\t read "+str(round(read_bytes['compressed']/1e6,2))+"MB, decompressed "+str(round(read_bytes['uncompressed']/1e6,2))+"MB"
+                  +" (eager: "+str(round(all_bytes['compressed']/1e6,2))+"MB, "+str(round(all_bytes['uncompressed']/1e6,2))+"MB)")
+
+        # compressed bytes per event of the branches read, to record bytes read from this file
+        bytes_per_event = sum(tree[b].compressed_bytes for b in variables)/max(numevents, 1)
+        timing = {'entries': nIn, 'seconds': elapsed, 'bytes': nIn*bytes_per_event}
+    
+    data = ak.concatenate(data_all) if data_all else ak.Array([]) # array containing events passing all cuts
+    return data, timing, histogram
+
+
+# Define function to get the path of a file, in the mirror if it has been mirrored
+def sample_path(s,val):
+    if s == 'data': prefix = "Data/" # Data prefix
+    else: # MC prefix
+        prefix = "MC/mc_"+str(infofile.infos[val]["DSID"])+"."
+    return hzz_mirror.resolve(tuple_path, prefix+val+".4lep.root") # file name to open
+
+# Define function to take tasks off the work queue until it is empty
+def claim_tasks():
+    todo = os.path.join(queue_path, 'todo')
+    claimed = os.path.join(queue_path, 'claimed')
+    while True:
+        names = sorted(os.listdir(todo)) # tasks are numbered in the order they should be done
+        if not names:
+            return # nothing left, every task has been claimed
+        for name in names:
+            try:
+                # renaming is atomic, so only one worker can claim each task
+                os.rename(os.path.join(todo, name), os.path.join(claimed, f'{name[:-5]}_rank{rank}.json'))
+            except FileNotFoundError:
+                continue # another worker got there first
+            with open(os.path.join(claimed, f'{name[:-5]}_rank{rank}.json'), 'r') as tf:
+                task = json.load(tf)
+            yield task
+            break # list the queue again, other workers may have taken tasks meanwhile
+
+# Define function to give the (category, sample, start point, end point) units of this rank
+def static_units():
+    for s in samples: # loop over samples
+        print('Processing '+s+' samples') # print which sample
+        for val in samples[s]['list']: # loop over each file
+            # +1 on the end point as it is the first point it ignores
+            yield s, val, start_dict[s][val], end_dict[s][val]+1
+
+# Define function to give units taken off the work queue
+def dynamic_units():
+    print('Taking tasks from the work queue')
+    for task in claim_tasks():
+        yield task['category'], task['sample'], task['start'], task['stop']
+
+# Define function to read and process one unit
+def process_unit(unit):
+    s, val, start_point, end_point = unit
+    return (s, val) + read_file(sample_path(s,val),val,start_point,end_point) # call the function read_file defined above
+
+# Define function to process units, several at once with --pool_size, giving results in the order of the units
+def run_units(units):
+    if args.pool_size <= 1:
+        yield from map(process_unit, units)
+        return
+
+    if args.pool == 'process':
+        # processes are forked, so they start with the start and end points already loaded
+        pool = ProcessPoolExecutor(max_workers=args.pool_size, mp_context=multiprocessing.get_context('fork'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=args.pool_size)
+    with pool:
+        futures = []
+        for unit in units:
+            futures.append(pool.submit(process_unit, unit))
+            # wait for a free slot before taking the next unit, so tasks are only claimed off the queue when they can start
+            while sum(not f.done() for f in futures) >= args.pool_size:
+                wait([f for f in futures if not f.done()], return_when=FIRST_COMPLETED)
+        for future in futures:
+            yield future.result()
+
+# Define function to get data from files
+def get_data_from_files():
+
+    frames = {s: [] for s in samples} # define empty lists to hold data of each sample
+    units = dynamic_units() if dynamic else static_units()
+    for s, val, temp, timing, histogram in run_units(units):
+        if rank_writer is not None:
+            rank_writer.write(val, temp) # only events of a process in the pool, the rest are already written
+        else:
+            frames[s].append(temp) # append array returned from read_file to list of awkward arrays
+        if timing is not None: # add to the timing of this file, it may be read in more than one unit
+            total = timings.setdefault(val, {'entries': 0, 'seconds': 0, 'bytes': 0})
+            for key in total:
+                total[key] += timing[key]
+        if histogram is not None:
+            hzz_histograms.add_histograms(histograms.setdefault(val, hzz_histograms.empty_histogram()), histogram)
+
+    data = {} # define empty dictionary to hold awkward arrays
+    for s in samples:
+        data[s] = ak.concatenate(frames[s]) if frames[s] else ak.Array([]) # dictionary entry is concatenated awkward arrays
+    
+    return data # return dictionary of awkward arrays
+
+# Define function to add the histograms of each file into histograms of each category
+def category_histograms():
+    categories = {}
+    for s in samples:
+        categories[s] = hzz_histograms.empty_histogram()
+        for val in samples[s]['list']:
+            if val in histograms: # file was processed by this rank
+                hzz_histograms.add_histograms(categories[s], histograms[val])
+    return categories
+
+#===================================================================================
+
+def main():
+    print('=======================')
+    print(f'Processing node {rank}')
+    print('=======================')
+
+    start = time.time() # time at start of whole processing
+    data = get_data_from_files() # process all files
+    elapsed = time.time() - start # time after whole processing
+    print("Time taken: "+str(round(elapsed,1))+"s") # print total time taken to process every file
+    if not args.no_byte_cache:
+        print(hzz_cache.summary())
+
+    # Save timings first, so they are there once the collector sees the data file
+    with hzz_handoff.atomic_open(f'./data/timings_{rank}.json', 'w') as t:
+        json.dump({'rank': rank, 'seconds': elapsed, 'files': timings}, t)
+
+    if args.output == 'histograms':
+        # histograms are the same size however many events were selected
+        output = f'hist_{rank}.pkl'
+        with hzz_handoff.atomic_open(f'./data/{output}', 'wb') as h:
+            pickle.dump({'bin_edges': hzz_histograms.bin_edges, 'samples': histograms, 'categories': category_histograms()}, h)
+            print(f'histograms from {rank} saved ({round(h.tell()/1e6,2)}MB)')
+    elif args.output == 'parquet':
+        output = f'data_{rank}.parquet'
+        size = rank_writer.close() # file is only put in place once it is complete
+        print(f'data from {rank} saved ({round(size/1e6,2)}MB, {rank_writer.rows} events)')
+    else:
+        output = f'data_{rank}.pkl'
+        with hzz_handoff.atomic_open(f'./data/{output}', 'wb') as d:
+            pickle.dump(data, d)
+            print(f'data from {rank} saved ({round(d.tell()/1e6,2)}MB)')
+
+    # Tell the collector this rank is done, only once all of its files are in place
+    hzz_handoff.mark_finished(rank, {'output': output, 'timings': f'timings_{rank}.json', 'seconds': elapsed})
+
+main()
+
+
+
+
+
+
+
+
+
@@ -0,0 +1,81 @@
+import awkward as ak # to represent nested data in columnar format
+import os
+import threading # chunks can be written from several threads with --pool_size
+
+# pyarrow is optional, without it the worker saves its events in a pickle at the end of the run
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    available = True
+except ImportError:
+    available = False
+
+#===================================================================================
+# Writer saving the selected events of a rank to a Parquet file as they are processed, used
+# with --output parquet instead of keeping every chunk in memory until the end of the run
+#
+# Every category goes into the one file, with a 'sample' column saying which file each event came
+# from. Chunks are gathered into row groups of at least min_rows events so the file does not end up
+# as thousands of tiny row groups, so at most one row group of events is held in memory. The file
+# is written under a temporary name and renamed once it is complete, so the collector never opens
+# a file that is still being written.
+
+# Fewest events in a row group, except the last
+min_rows = 65536
+
+# Columns missing from a chunk are filled with nulls of this type, only totalWeight can be missing (real data)
+missing_type = pa.float64() if available else None
+
+class RankWriter:
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.writer = None # opened with the schema of the first chunk
+        self.pending = [] # tables not yet written
+        self.pending_rows = 0
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    # Define function to add the events of a chunk from a sample
+    def write(self, sample, data):
+        if len(data) == 0:
+            return
+        table = ak.to_arrow_table(data, extensionarray=False) # plain arrow types, readable without awkward
+        table = table.append_column('sample', pa.array([sample]*len(data)).dictionary_encode())
+        with self.lock:
+            if self.writer is None:
+                fields = list(table.schema)
+                if 'mllll' in table.column_names and 'totalWeight' not in table.column_names:
+                    fields.insert(table.column_names.index('mllll'), pa.field('totalWeight', missing_type)) # first chunk is real data
+                # every column nullable, the first chunk may be MC whose totalWeight has no nulls while real data's is all null
+                self.writer = pq.ParquetWriter(self.temp_path, pa.schema([field.with_nullable(True) for field in fields]))
+            self.pending.append(self.conform(table))
+            self.pending_rows += len(table)
+            if self.pending_rows >= min_rows:
+                self.flush()
+
+    # Define function to give a table the columns, in order, and types of the file
+    def conform(self, table):
+        schema = self.writer.schema
+        for field in schema:
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(len(table), field.type))
+        return table.select(schema.names).cast(schema)
+
+    # Define function to write the pending tables as one row group
+    def flush(self):
+        if self.pending:
+            self.writer.write_table(pa.concat_tables(self.pending), row_group_size=self.pending_rows)
+            self.rows += self.pending_rows
+            self.pending, self.pending_rows = [], 0
+
+    # Define function to write what is left and put the complete file in place, returns its size in bytes
+    def close(self):
+        with self.lock:
+            if self.writer is None:
+                # no events passed, write an empty file so the collector knows this rank is done
+                self.writer = pq.ParquetWriter(self.temp_path, pa.schema([('sample', pa.dictionary(pa.int32(), pa.string()))]))
+            self.flush()
+            self.writer.close()
+            os.replace(self.temp_path, self.path)
+        return os.path.getsize(self.path)